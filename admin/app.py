@@ -58,7 +58,7 @@ class AdminModel(db.Model, UserMixin):
     email = db.Column(db.String(255), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
     active = db.Column(db.Boolean())
-    confirmed_at = db.Column(db.DateTime(), default=datetime.utcnow)
+    confirmed_at = db.Column(db.DateTime(), default=db.func.now())
     fs_uniquifier = db.Column(db.String(255), unique=True)
     roles = db.relationship("RoleModel", secondary=roles_admins, backref=db.backref("admins", lazy="dynamic"))
 
@@ -126,8 +126,7 @@ def get_user_count() -> int:
     return db.session.query(AppUserModel).count()
 
 
-def get_new_user_count(days_before: int = 1) -> int:
-    period_start = datetime.now(timezone.utc) - timedelta(days=days_before)
+def get_new_user_count(period_start: datetime) -> int:
     return db.session.query(AppUserModel).filter(AppUserModel.created_at >= period_start).count()
 
 
@@ -138,8 +137,7 @@ class CustomAdminIndexView(AdminIndexView):
         period_start = datetime.now(timezone.utc) - timedelta(days=days_before)
         order_count = get_orders_count()
         user_count = get_user_count()
-        new_user_count = get_new_user_count(days_before)
-        new_user_count = get_new_user_count(days_before)
+        new_user_count = get_new_user_count(period_start)
 
         return self.render(
             "admin/index.html",
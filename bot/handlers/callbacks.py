@@ -1,112 +1,82 @@
-import json
-import uuid
-from datetime import datetime, timezone
-from aiogram import Router
-from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from types import MappingProxyType
+
+from aiogram import F, Router
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery
+from sqlalchemy import func, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from shared.models import User, ImageProcessingJob, ProcessingStatus
-from bot.services.task_publisher import publish_processing_task
-from aiogram.utils.i18n import gettext as _
+from bot.handlers.photo import create_processing_keyboard
+from bot.services.task_publisher import notify_outbox, outbox_entry
+from bot.services.user_cache import forget_user
+from bot.utils.callback_data import ProcessCallback, ToggleCallback
+from bot.utils.i18n import gettext as _
 
 router = Router(name="callbacks")
-router.callback_query.filter(lambda c: c.data and (c.data.startswith("process:") or c.data.startswith("toggle:")))
-
-
-def parse_callback_data(callback_data: str) -> tuple[str, str, uuid.UUID]:
-    """Parse callback data into action type, action, and job_id"""
-    parts = callback_data.split(":")
-    if len(parts) < 3:
-        raise ValueError("Invalid callback data format")
-
-    action_type = parts[0]  # "process" or "toggle"
-    action = parts[1]
-    job_id = uuid.UUID(parts[2])
-
-    return action_type, action, job_id
-
-
-def create_updated_keyboard(job_id: uuid.UUID, options: dict) -> InlineKeyboardMarkup:
-    """Create keyboard with updated toggle states"""
-    remove_bg = options.get("remove_bg", False)
-    as_sticker = options.get("as_sticker", False)
-
-    bg_text = "✅ Remove BG" if remove_bg else "🖼️ Remove BG"
-    sticker_text = "✅ As Sticker" if as_sticker else "🎨 As Sticker"
-
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text=bg_text,
-                    callback_data=f"toggle:bg:{job_id}"
-                ),
-                InlineKeyboardButton(
-                    text=sticker_text,
-                    callback_data=f"toggle:sticker:{job_id}"
-                ),
-            ],
-            [
-                InlineKeyboardButton(
-                    text="▶️ Process",
-                    callback_data=f"process:start:{job_id}"
-                ),
-            ],
-        ]
-    )
-
-
-async def get_job_options(job: ImageProcessingJob) -> dict:
-    """Get current processing options from job"""
-    try:
-        return json.loads(job.processing_options)
-    except (json.JSONDecodeError, TypeError):
-        return {"remove_bg": False, "as_sticker": False}
 
+# Toggle action -> processing option key
+TOGGLE_OPTIONS = MappingProxyType({
+    "bg": "remove_bg",
+    "sticker": "as_sticker",
+})
 
-async def update_job_options(job: ImageProcessingJob, options: dict):
-    """Update job processing options"""
-    job.processing_options = json.dumps(options)
-    job.updated_at = datetime.now(timezone.utc)
 
+async def get_owned_job(session: AsyncSession, job_key: str, user: User):
+    """Get a job and its owner in one round trip, None unless the job belongs to the user"""
+    result = await session.execute(
+        select(ImageProcessingJob, User)
+        .join(User, User.id == ImageProcessingJob.user_id)
+        .where(ImageProcessingJob.short_id == job_key)
+    )
+    row = result.first()
+    if not row or row.User.id != user.id:
+        return None
+    return row
+
+
+@router.callback_query(ToggleCallback.filter())
+async def handle_toggle(callback: CallbackQuery, callback_data: ToggleCallback) -> None:
+    """Handle toggle button clicks, options live on the keyboard until Process is pressed"""
+    key = TOGGLE_OPTIONS.get(callback_data.option)
+    if key is None:
+        await callback.answer(_("❌ Unknown action"), show_alert=True)
+        return
 
-async def handle_toggle(
-        callback: CallbackQuery,
-        job: ImageProcessingJob,
-        action: str,
-) -> None:
-    """Handle toggle button clicks"""
-    options = await get_job_options(job)
-
-    # Toggle the option
-    if action == "bg":
-        options["remove_bg"] = not options.get("remove_bg", False)
-    elif action == "sticker":
-        options["as_sticker"] = not options.get("as_sticker", False)
-
-    # Update job options (will be saved when processing starts)
-    await update_job_options(job, options)
+    options = {"remove_bg": callback_data.remove_bg, "as_sticker": callback_data.as_sticker}
+    options[key] = not options[key]
 
     # Update keyboard to show new state
-    keyboard = create_updated_keyboard(job.id, options)
+    keyboard = create_processing_keyboard(callback_data.job_key, **options)
 
     try:
         await callback.message.edit_reply_markup(reply_markup=keyboard)
-    except Exception:
+    except TelegramBadRequest:
         # Message might be too old to edit
         pass
 
     await callback.answer()
 
 
+@router.callback_query(ProcessCallback.filter())
 async def handle_process_start(
         callback: CallbackQuery,
+        callback_data: ProcessCallback,
         user: User,
-        job: ImageProcessingJob,
         session: AsyncSession,
 ) -> None:
     """Handle process start button click"""
-    options = await get_job_options(job)
+    if callback_data.action != "start":
+        await callback.answer(_("❌ Unknown action"), show_alert=True)
+        return
+
+    row = await get_owned_job(session, callback_data.job_key, user)
+    if row is None:
+        await callback.answer(_("❌ Job not found or access denied"), show_alert=True)
+        return
+    job, user = row.ImageProcessingJob, row.User
+
+    options = {"remove_bg": callback_data.remove_bg, "as_sticker": callback_data.as_sticker}
 
     if not options.get("remove_bg") and not options.get("as_sticker"):
         await callback.answer("⚠️ Please select at least one option!", show_alert=True)
@@ -116,26 +86,34 @@ async def handle_process_start(
     options["user_tier"] = user.tier.value
     options["telegram_message_id"] = callback.message.message_id
 
-    # Get user from DB for quota update
-    db_user = await session.get(User, user.id)
-    if not db_user:
-        await callback.message.answer(_("❌ User not found"))
-        return
-
-    db_user.quota_used += 1
+    # Atomic quota increment, returns the fresh counters
+    result = await session.execute(
+        update(User)
+        .where(User.id == user.id)
+        .values(quota_used=User.quota_used + 1)
+        .returning(User.quota_used, User.quota_limit)
+    )
+    quota_used, quota_limit = result.one()
+    forget_user(user.telegram_id)
 
     # Update job
-    job.processing_options = json.dumps(options)
-    job.status = ProcessingStatus.PENDING
-    job.updated_at = datetime.now(timezone.utc)
+    await session.execute(
+        update(ImageProcessingJob)
+        .where(ImageProcessingJob.id == job.id)
+        .values(
+            processing_options=options,
+            status=ProcessingStatus.QUEUED,
+            updated_at=func.now(),
+        )
+    )
 
-    # Commit both updates
-    await session.commit()
+    # Queue the task in the same transaction, the outbox relay publishes it
+    session.add(outbox_entry(str(job.id), options))
 
-    # Publish to processing queue
-    await publish_processing_task(str(job.id), options)
+    await session.commit()
+    notify_outbox()
 
-    remaining = db_user.quota_limit - db_user.quota_used
+    remaining = quota_limit - quota_used
 
     # Build status message
     status_parts = []
@@ -146,48 +124,28 @@ async def handle_process_start(
 
     status_text = " + ".join(status_parts)
 
-    try:
-        await callback.message.delete()
-    except Exception:
-        pass
-
-    await callback.message.answer(
-        _("✅ Processing started: {status}\n\n"
-          "Job ID: {job_id}\n"
-          "Remaining credits: {remaining}").format(
-            status=status_text,
-            job_id=job.id,
-            remaining=remaining
-        )
+    status_message = _("✅ Processing started: {status}\n\n"
+                       "Job ID: {job_id}\n"
+                       "Remaining credits: {remaining}").format(
+        status=status_text,
+        job_id=job.id,
+        remaining=remaining
     )
 
-    await callback.answer()
-
-
-@router.callback_query()
-async def handle_processing_callback(
-        callback: CallbackQuery,
-        user: User,
-        session: AsyncSession,
-):
-    """Handle processing option selection"""
+    # Turn the prompt into the status message with a single request
     try:
-        action_type, action, job_id = parse_callback_data(callback.data)
-    except (ValueError, IndexError):
-        await callback.answer(_("❌ Invalid callback data"), show_alert=True)
-        return
+        if callback.message.photo:
+            await callback.message.edit_caption(caption=status_message, reply_markup=None)
+        else:
+            await callback.message.edit_text(status_message, reply_markup=None)
+    except TelegramBadRequest:
+        # Message can't be edited anymore
+        await callback.message.answer(status_message)
+
+    await callback.answer()
 
-    # Get job
-    job = await session.get(ImageProcessingJob, job_id)
-    if not job or job.user_id != user.id:
-        await callback.answer(_("❌ Job not found or access denied"), show_alert=True)
-        return
 
-    # Route to appropriate handler
-    if action_type == "toggle":
-        await handle_toggle(callback, job, action)
-        await session.commit()
-    elif action_type == "process" and action == "start":
-        await handle_process_start(callback, user, job, session)
-    else:
-        await callback.answer(_("❌ Unknown action"), show_alert=True)
\ No newline at end of file
+@router.callback_query(F.data.startswith(("toggle:", "process:")))
+async def handle_stale_keyboard(callback: CallbackQuery) -> None:
+    """Answer buttons of keyboards sent before options were carried in the callback data"""
+    await callback.answer(_("⚠️ These buttons have expired, please send the image again"), show_alert=True)
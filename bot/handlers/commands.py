@@ -1,6 +1,6 @@
 from aiogram import Router, types
 from aiogram.filters import CommandStart, Command
-from aiogram.utils.i18n import gettext as _
+from bot.utils.i18n import gettext as _
 
 from shared.models import User
 
@@ -1,12 +1,19 @@
 import logging
+from types import MappingProxyType
 from datetime import datetime, timedelta, timezone
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.utils.i18n import gettext as _
-from sqlalchemy import select, and_, desc
+from bot.utils.i18n import gettext as _
+from cachetools import TTLCache
+from sqlalchemy import select, update, and_, desc, func, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
+from bot.handlers.photo import create_processing_keyboard
+from bot.services.task_publisher import notify_outbox, outbox_entry
+from bot.services.user_cache import forget_user
 from shared.models import User, ImageProcessingJob, ProcessingStatus
 
 router = Router(name="history")
@@ -15,72 +22,142 @@ logger = logging.getLogger(__name__)
 # Constants
 JOBS_PER_PAGE = 5
 RECENT_HOURS = 24
+RECENT_WINDOW = timedelta(hours=RECENT_HOURS)
+FILENAME_MAX_LENGTH = 30
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
+# Batch option -> (processing options, status label)
+BATCH_OPTIONS = MappingProxyType({
+    "bg": ({"remove_bg": True, "as_sticker": False}, "🖼️ Remove Background"),
+    "sticker": ({"remove_bg": False, "as_sticker": True}, "🎨 Convert to Sticker"),
+    "both": ({"remove_bg": True, "as_sticker": True}, "✅ Remove BG + Sticker"),
+})
 
-async def get_recent_jobs(session: AsyncSession, user_id: int, page: int = 0):
-    """Get recent jobs for user with pagination"""
-    offset = page * JOBS_PER_PAGE
+# (chat id, message id) -> hash of the history page last rendered into that message
+HISTORY_RENDER_TTL = 60
+rendered_history = TTLCache(maxsize=10_000, ttl=HISTORY_RENDER_TTL)
 
-    # Get jobs from last 24 hours, ordered by creation time
-    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=RECENT_HOURS)
+# Job status -> emoji
+STATUS_EMOJI = MappingProxyType({
+    ProcessingStatus.PENDING: "⏳",
+    ProcessingStatus.QUEUED: "📤",
+    ProcessingStatus.PROCESSING: "⚙️",
+    ProcessingStatus.COMPLETED: "✅",
+    ProcessingStatus.FAILED: "❌",
+})
 
-    stmt = (
-        select(ImageProcessingJob)
-        .where(
-            and_(
-                ImageProcessingJob.user_id == user_id,
-                ImageProcessingJob.created_at >= cutoff_time,
-            )
-        )
-        .order_by(desc(ImageProcessingJob.created_at))
-        .limit(JOBS_PER_PAGE)
-        .offset(offset)
-    )
 
-    result = await session.execute(stmt)
-    jobs = result.scalars().all()
+def encode_cursor(job: ImageProcessingJob) -> str:
+    """Keyset cursor for a job: created_at in epoch microseconds + short id"""
+    micros = (job.created_at - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}:{job.short_id}"
 
-    return jobs
 
+def decode_cursor(raw: str) -> tuple[datetime, str]:
+    """Inverse of encode_cursor"""
+    micros, short_id = raw.split(":", 1)
+    return EPOCH + timedelta(microseconds=int(micros)), short_id
 
-async def count_recent_jobs(session: AsyncSession, user_id: int) -> int:
-    """Count total recent jobs for pagination"""
-    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=RECENT_HOURS)
 
-    stmt = (
-        select(ImageProcessingJob)
+def recent_jobs_filter(model, user_id: int, now: datetime):
+    """WHERE clause for a user's jobs from the recent window ending at now"""
+    return and_(model.user_id == user_id, model.created_at >= now - RECENT_WINDOW)
+
+
+async def get_recent_jobs(
+        session: AsyncSession,
+        user_id: int,
+        now: datetime,
+        cursor: tuple[datetime, str] | None = None,
+        direction: str = "next",
+) -> tuple[list[ImageProcessingJob], int, bool]:
+    """
+    Get one page of recent jobs for user together with the total job count
+    and whether any of them is pending, in a single query.
+
+    Pages are keyset-paginated on (created_at, short_id), newest first:
+    "next" returns jobs older than cursor, "prev" jobs newer than cursor,
+    "at" jobs starting from cursor. Without a cursor returns the first page.
+    """
+    # Get jobs from last 24 hours, ordered by creation time
+    # Totals are computed over the whole window, independent of the cursor
+    counted = aliased(ImageProcessingJob)
+    total_count = (
+        select(func.count())
+        .select_from(counted)
+        .where(recent_jobs_filter(counted, user_id, now))
+        .scalar_subquery()
+        .label("total_count")
+    )
+    has_pending = (
+        select(counted.id)
         .where(
-            and_(
-                ImageProcessingJob.user_id == user_id,
-                ImageProcessingJob.created_at >= cutoff_time,
-            )
+            recent_jobs_filter(counted, user_id, now),
+            counted.status == ProcessingStatus.PENDING,
         )
+        .exists()
+        .label("has_pending")
     )
 
+    key = tuple_(ImageProcessingJob.created_at, ImageProcessingJob.short_id)
+    newest_first = (desc(ImageProcessingJob.created_at), desc(ImageProcessingJob.short_id))
+
+    stmt = (
+        select(ImageProcessingJob, total_count, has_pending)
+        .where(recent_jobs_filter(ImageProcessingJob, user_id, now))
+        .limit(JOBS_PER_PAGE)
+    )
+
+    if cursor is None:
+        stmt = stmt.order_by(*newest_first)
+    elif direction == "prev":
+        stmt = stmt.where(key > tuple_(*cursor)).order_by(
+            ImageProcessingJob.created_at, ImageProcessingJob.short_id
+        )
+    elif direction == "at":
+        stmt = stmt.where(key <= tuple_(*cursor)).order_by(*newest_first)
+    else:
+        stmt = stmt.where(key < tuple_(*cursor)).order_by(*newest_first)
+
     result = await session.execute(stmt)
-    return len(result.scalars().all())
+    rows = result.all()
+    if not rows:
+        return [], 0, False
+
+    if cursor is not None and direction == "prev":
+        rows.reverse()
+
+    jobs = [row.ImageProcessingJob for row in rows]
+    return jobs, rows[0].total_count, rows[0].has_pending
 
 
 def get_status_emoji(status: ProcessingStatus) -> str:
     """Get emoji for job status"""
-    status_map = {
-        ProcessingStatus.PENDING: "⏳",
-        ProcessingStatus.PROCESSING: "⚙️",
-        ProcessingStatus.COMPLETED: "✅",
-        ProcessingStatus.FAILED: "❌",
-    }
-    return status_map.get(status, "❓")
+    return STATUS_EMOJI.get(status, "❓")
+
+
+def count_pages(total_jobs: int) -> int:
+    """Number of history pages needed for total_jobs"""
+    return (total_jobs + JOBS_PER_PAGE - 1) // JOBS_PER_PAGE
+
 
+def render_hash(text: str, keyboard: InlineKeyboardMarkup) -> int:
+    """Hash of a rendered history page, used to skip no-op edits"""
+    return hash((text, tuple(button.callback_data for row in keyboard.inline_keyboard for button in row)))
 
-def format_job_info(job: ImageProcessingJob, index: int) -> str:
+
+def truncate(text: str, max_length: int) -> str:
+    """Shorten text to max_length characters, ending with an ellipsis when cut"""
+    return text if len(text) <= max_length else text[:max_length - 3] + "..."
+
+
+def format_job_info(job: ImageProcessingJob, index: int, now: datetime) -> str:
     """Format single job information"""
     status_emoji = get_status_emoji(job.status)
-    time_ago = get_time_ago(job.created_at)
+    time_ago = get_time_ago(job.created_at, now)
 
     # Extract filename (remove path)
-    filename = job.original_filename.split("/")[-1]
-    if len(filename) > 30:
-        filename = filename[:27] + "..."
+    filename = truncate(job.original_filename.rpartition("/")[2], FILENAME_MAX_LENGTH)
 
     return (
         f"{index}. {status_emoji} *{filename}*\n"
@@ -90,9 +167,8 @@ def format_job_info(job: ImageProcessingJob, index: int) -> str:
     )
 
 
-def get_time_ago(dt: datetime) -> str:
-    """Get human-readable time difference"""
-    now = datetime.now(timezone.utc)
+def get_time_ago(dt: datetime, now: datetime) -> str:
+    """Get human-readable time difference to now"""
     diff = now - dt
 
     if diff.days > 0:
@@ -107,30 +183,38 @@ def get_time_ago(dt: datetime) -> str:
         return "just now"
 
 
-def create_history_keyboard(page: int, total_jobs: int, has_pending: bool) -> InlineKeyboardMarkup:
+def create_history_keyboard(
+        page: int,
+        total_jobs: int,
+        has_pending: bool,
+        jobs: list[ImageProcessingJob],
+) -> InlineKeyboardMarkup:
     """Create keyboard for history navigation"""
     buttons = []
 
-    # Batch process button (only if there are pending jobs)
+    # Pagination buttons, keyed by the first/last job on this page
+    first_cursor = encode_cursor(jobs[0])
+    last_cursor = encode_cursor(jobs[-1])
+
+    # Batch process button (only if there are pending jobs), carries this page to come back to
     if has_pending:
         buttons.append([
             InlineKeyboardButton(
                 text="🔄 Process All Pending",
-                callback_data=f"batch:process_all:{page}"
+                callback_data=f"batch:process_all:{page}:{first_cursor}"
             )
         ])
 
-    # Pagination buttons
     nav_buttons = []
     if page > 0:
         nav_buttons.append(
-            InlineKeyboardButton(text="⬅️ Previous", callback_data=f"history:page:{page - 1}")
+            InlineKeyboardButton(text="⬅️ Previous", callback_data=f"history:prev:{page - 1}:{first_cursor}")
         )
 
-    total_pages = (total_jobs + JOBS_PER_PAGE - 1) // JOBS_PER_PAGE
+    total_pages = count_pages(total_jobs)
     if page < total_pages - 1:
         nav_buttons.append(
-            InlineKeyboardButton(text="Next ➡️", callback_data=f"history:page:{page + 1}")
+            InlineKeyboardButton(text="Next ➡️", callback_data=f"history:next:{page + 1}:{last_cursor}")
         )
 
     if nav_buttons:
@@ -138,30 +222,43 @@ def create_history_keyboard(page: int, total_jobs: int, has_pending: bool) -> In
 
     # Refresh button
     buttons.append([
-        InlineKeyboardButton(text="🔄 Refresh", callback_data=f"history:page:{page}")
+        InlineKeyboardButton(text="🔄 Refresh", callback_data=f"history:at:{page}:{first_cursor}")
     ])
 
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def create_job_action_keyboard(job_id: str) -> InlineKeyboardMarkup:
+def create_job_action_keyboard(job_key: str) -> InlineKeyboardMarkup:
     """Create keyboard for individual job actions"""
+    return create_processing_keyboard(job_key)
+
+
+def create_batch_options_keyboard(history_page: str) -> InlineKeyboardMarkup:
+    """Create keyboard for choosing batch processing options, history_page is "<page>:<cursor>" to go back to"""
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
                 InlineKeyboardButton(
-                    text="🖼️ Remove BG",
-                    callback_data=f"toggle:bg:{job_id}"
+                    text="🖼️ Remove BG Only",
+                    callback_data="batch:options:bg"
                 ),
+            ],
+            [
                 InlineKeyboardButton(
-                    text="🎨 As Sticker",
-                    callback_data=f"toggle:sticker:{job_id}"
+                    text="🎨 Sticker Only",
+                    callback_data="batch:options:sticker"
                 ),
             ],
             [
                 InlineKeyboardButton(
-                    text="▶️ Process",
-                    callback_data=f"process:start:{job_id}"
+                    text="✅ Both (BG + Sticker)",
+                    callback_data="batch:options:both"
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    text="🔙 Back to History",
+                    callback_data=f"history:at:{history_page}"
                 ),
             ],
         ]
@@ -175,8 +272,8 @@ async def handle_history_command(
         session: AsyncSession,
 ):
     """Show user's recent processing history"""
-    jobs = await get_recent_jobs(session, user.id, page=0)
-    total_jobs = await count_recent_jobs(session, user.id)
+    now = datetime.now(timezone.utc)
+    jobs, total_jobs, has_pending = await get_recent_jobs(session, user.id, now)
 
     if not jobs:
         return await message.answer(
@@ -184,63 +281,69 @@ async def handle_history_command(
               "Upload an image to get started!")
         )
 
-    # Check if there are pending jobs
-    has_pending = any(job.status == ProcessingStatus.PENDING for job in jobs)
-
     # Format job list
-    job_lines = [format_job_info(job, i + 1) for i, job in enumerate(jobs)]
+    job_lines = [format_job_info(job, i + 1, now) for i, job in enumerate(jobs)]
     jobs_text = "\n\n".join(job_lines)
 
     # Create message
     text = (
         f"📋 *Your Recent Jobs* (Last {RECENT_HOURS}h)\n"
-        f"Total: {total_jobs} | Page: 1/{(total_jobs + JOBS_PER_PAGE - 1) // JOBS_PER_PAGE}\n\n"
+        f"Total: {total_jobs} | Page: 1/{count_pages(total_jobs)}\n\n"
         f"{jobs_text}"
     )
 
-    keyboard = create_history_keyboard(0, total_jobs, has_pending)
+    keyboard = create_history_keyboard(0, total_jobs, has_pending, jobs)
 
-    await message.answer(
+    sent = await message.answer(
         text,
         parse_mode="Markdown",
         reply_markup=keyboard
     )
+    rendered_history[sent.chat.id, sent.message_id] = render_hash(text, keyboard)
 
 
-@router.callback_query(F.data.startswith("history:page:"))
+@router.callback_query(F.data.startswith("history:"))
 async def handle_history_page(
         callback: CallbackQuery,
         user: User,
         session: AsyncSession,
 ):
     """Handle history pagination"""
+    # history:<direction>:<page>:<cursor> moves from a cursor
+    parts = callback.data.split(":", 3)
     try:
-        page = int(callback.data.split(":")[-1])
-    except ValueError:
+        direction = parts[1]
+        page, cursor = int(parts[2]), decode_cursor(parts[3])
+    except (ValueError, IndexError):
         await callback.answer("❌ Invalid page number")
         return
 
-    jobs = await get_recent_jobs(session, user.id, page=page)
-    total_jobs = await count_recent_jobs(session, user.id)
+    now = datetime.now(timezone.utc)
+    jobs, total_jobs, has_pending = await get_recent_jobs(session, user.id, now, cursor, direction)
 
     if not jobs:
         await callback.answer("No jobs on this page")
         return
 
-    has_pending = any(job.status == ProcessingStatus.PENDING for job in jobs)
-
     # Format job list
-    job_lines = [format_job_info(job, page * JOBS_PER_PAGE + i + 1) for i, job in enumerate(jobs)]
+    job_lines = [format_job_info(job, page * JOBS_PER_PAGE + i + 1, now) for i, job in enumerate(jobs)]
     jobs_text = "\n\n".join(job_lines)
 
     # Create message
     text = (
         f"📋 *Your Recent Jobs* (Last {RECENT_HOURS}h)\n"
-        f"Total: {total_jobs} | Page: {page + 1}/{(total_jobs + JOBS_PER_PAGE - 1) // JOBS_PER_PAGE}\n\n"
+        f"Total: {total_jobs} | Page: {page + 1}/{count_pages(total_jobs)}\n\n"
         f"{jobs_text}"
     )
 
-    keyboard = create_history_keyboard(page, total_jobs, has_pending)
+    keyboard = create_history_keyboard(page, total_jobs, has_pending, jobs)
+
+    # Skip the edit when the message already shows this exact page
+    render_key = (callback.message.chat.id, callback.message.message_id)
+    page_hash = render_hash(text, keyboard)
+    if rendered_history.get(render_key) == page_hash:
+        await callback.answer("Up to date")
+        return
 
     try:
         await callback.message.edit_text(
@@ -248,9 +351,10 @@ async def handle_history_page(
             parse_mode="Markdown",
             reply_markup=keyboard
         )
-    except Exception:
+    except TelegramBadRequest:
         # Message content hasn't changed
         pass
+    rendered_history[render_key] = page_hash
 
     await callback.answer()
 
@@ -262,66 +366,34 @@ async def handle_batch_process(
         session: AsyncSession,
 ):
     """Process all pending jobs with same options"""
-    try:
-        page = int(callback.data.split(":")[-1])
-    except ValueError:
-        page = 0
-
-    # Get all pending jobs for this user
-    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=RECENT_HOURS)
+    # batch:process_all:<page>:<cursor>, the history page the back button returns to
+    history_page = callback.data.split(":", 2)[2]
 
+    # Count pending jobs for this user, the options handler fetches them
     stmt = (
-        select(ImageProcessingJob)
+        select(func.count())
+        .select_from(ImageProcessingJob)
         .where(
-            and_(
-                ImageProcessingJob.user_id == user.id,
-                ImageProcessingJob.status == ProcessingStatus.PENDING,
-                ImageProcessingJob.created_at >= cutoff_time,
-            )
+            recent_jobs_filter(ImageProcessingJob, user.id, datetime.now(timezone.utc)),
+            ImageProcessingJob.status == ProcessingStatus.PENDING,
         )
-        .order_by(desc(ImageProcessingJob.created_at))
     )
 
-    result = await session.execute(stmt)
-    pending_jobs = result.scalars().all()
+    pending_count = (await session.execute(stmt)).scalar_one()
 
-    if not pending_jobs:
+    if not pending_count:
         await callback.answer("No pending jobs to process", show_alert=True)
         return
 
     # Show batch options selection
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="🖼️ Remove BG Only",
-                    callback_data=f"batch:options:bg:{page}"
-                ),
-            ],
-            [
-                InlineKeyboardButton(
-                    text="🎨 Sticker Only",
-                    callback_data=f"batch:options:sticker:{page}"
-                ),
-            ],
-            [
-                InlineKeyboardButton(
-                    text="✅ Both (BG + Sticker)",
-                    callback_data=f"batch:options:both:{page}"
-                ),
-            ],
-            [
-                InlineKeyboardButton(
-                    text="🔙 Back to History",
-                    callback_data=f"history:page:{page}"
-                ),
-            ],
-        ]
-    )
+    keyboard = create_batch_options_keyboard(history_page)
+
+    # The history page is replaced, a later "Back to History" must re-render it
+    rendered_history.pop((callback.message.chat.id, callback.message.message_id), None)
 
     await callback.message.edit_text(
         f"🔄 *Batch Processing*\n\n"
-        f"Found {len(pending_jobs)} pending jobs.\n"
+        f"Found {pending_count} pending jobs.\n"
         f"Choose processing options for all:",
         parse_mode="Markdown",
         reply_markup=keyboard
@@ -337,78 +409,79 @@ async def handle_batch_options(
         session: AsyncSession,
 ):
     """Execute batch processing with selected options"""
-    from bot.services.task_publisher import publish_processing_task
-    import json
-
     parts = callback.data.split(":")
     option = parts[2]  # "bg", "sticker", or "both"
-    page = int(parts[3])
-
-    # Determine options
-    if option == "bg":
-        options = {"remove_bg": True, "as_sticker": False}
-        status_text = "🖼️ Remove Background"
-    elif option == "sticker":
-        options = {"remove_bg": False, "as_sticker": True}
-        status_text = "🎨 Convert to Sticker"
-    else:  # both
-        options = {"remove_bg": True, "as_sticker": True}
-        status_text = "✅ Remove BG + Sticker"
-
-    # Get all pending jobs
-    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=RECENT_HOURS)
 
+    # Determine options (anything unknown falls back to "both")
+    preset, status_text = BATCH_OPTIONS.get(option, BATCH_OPTIONS["both"])
+    options = dict(preset)
+
+    # Lock ids of all pending jobs. They are queued below, so a repeated batch no longer
+    # matches them, and SKIP LOCKED keeps a batch running at the same time off the same rows
     stmt = (
-        select(ImageProcessingJob)
+        select(ImageProcessingJob.id)
         .where(
-            and_(
-                ImageProcessingJob.user_id == user.id,
-                ImageProcessingJob.status == ProcessingStatus.PENDING,
-                ImageProcessingJob.created_at >= cutoff_time,
-            )
+            recent_jobs_filter(ImageProcessingJob, user.id, datetime.now(timezone.utc)),
+            ImageProcessingJob.status == ProcessingStatus.PENDING,
         )
+        .with_for_update(skip_locked=True)
     )
 
     result = await session.execute(stmt)
-    pending_jobs = result.scalars().all()
+    job_ids = result.scalars().all()
 
-    if not pending_jobs:
+    if not job_ids:
         await callback.answer("No pending jobs found", show_alert=True)
         return
 
-    # Check quota
-    db_user = await session.get(User, user.id)
-    remaining = db_user.quota_limit - db_user.quota_used
+    # Check and charge quota atomically
+    result = await session.execute(
+        update(User)
+        .where(User.id == user.id, User.quota_limit - User.quota_used >= len(job_ids))
+        .values(quota_used=User.quota_used + len(job_ids))
+        .returning(User.quota_limit - User.quota_used)
+    )
+    remaining_after = result.scalar()
 
-    if remaining < len(pending_jobs):
+    if remaining_after is None:
+        # The cached user may be stale, report the quota as it stands now
+        remaining = (await session.execute(
+            select(User.quota_limit - User.quota_used).where(User.id == user.id)
+        )).scalar_one()
         await callback.answer(
-            f"❌ Not enough credits! Need {len(pending_jobs)}, have {remaining}",
+            f"❌ Not enough credits! Need {len(job_ids)}, have {remaining}",
             show_alert=True
         )
         return
 
-    # Update quota
-    db_user.quota_used += len(pending_jobs)
+    forget_user(user.telegram_id)
 
     # Process all jobs
     options["user_tier"] = user.tier.value
 
-    for job in pending_jobs:
-        job.processing_options = json.dumps(options)
-        job.status = ProcessingStatus.PENDING
-        job.updated_at = datetime.now(timezone.utc)
+    await session.execute(
+        update(ImageProcessingJob)
+        .where(ImageProcessingJob.id.in_(job_ids))
+        .values(
+            processing_options=options,
+            status=ProcessingStatus.QUEUED,
+            updated_at=func.now(),
+        )
+        .execution_options(synchronize_session=False)
+    )
 
-        # Publish to queue
-        await publish_processing_task(str(job.id), options)
+    # Queue the tasks in the same transaction, the outbox relay publishes them in bulk
+    session.add_all([outbox_entry(str(job_id), options) for job_id in job_ids])
 
     await session.commit()
+    notify_outbox()
 
-    remaining_after = db_user.quota_limit - db_user.quota_used
+    rendered_history.pop((callback.message.chat.id, callback.message.message_id), None)
 
     await callback.message.edit_text(
         f"✅ *Batch Processing Started!*\n\n"
         f"Processing: {status_text}\n"
-        f"Jobs queued: {len(pending_jobs)}\n"
+        f"Jobs queued: {len(job_ids)}\n"
         f"Remaining credits: {remaining_after}\n\n"
         f"You'll receive results shortly.",
         parse_mode="Markdown"
@@ -1,62 +1,166 @@
 import asyncio
-import time
 import uuid
-from datetime import datetime, timezone
+from collections import Counter
+from contextlib import asynccontextmanager
 from io import BytesIO
-from typing import Optional
+from types import MappingProxyType
+from typing import AsyncIterator, Optional
 
+import prometheus_client
 from aiogram import Router, F, Bot
-from aiogram.types import BufferedInputFile, Message, File, InlineKeyboardMarkup, InlineKeyboardButton
+from cachetools import TTLCache
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, Message, InlineKeyboardMarkup, InlineKeyboardButton
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from shared.config import settings
-from shared.models import User, ImageProcessingJob, ProcessingStatus
+from shared.models import User, ImageProcessingJob, ProcessingStatus, generate_short_id
 from shared.s3_client import s3_client
+from bot.middlewares.prometheus import METRICS_PREFIX
 from loguru import logger
-from aiogram.utils.i18n import gettext as _
+from bot.utils.callback_data import ProcessCallback, ToggleCallback
+from bot.utils.i18n import gettext as _
 
 router = Router(name="photo")
 router.message.filter(F.photo | F.document)
 
+# (remove_bg, as_sticker) -> (bg button text, sticker button text)
+TOGGLE_TEXTS = MappingProxyType({
+    (False, False): ("🖼️ Remove BG", "🎨 As Sticker"),
+    (True, False): ("✅ Remove BG", "🎨 As Sticker"),
+    (False, True): ("🖼️ Remove BG", "✅ As Sticker"),
+    (True, True): ("✅ Remove BG", "✅ As Sticker"),
+})
+
+# Upload size limit
+MAX_FILE_SIZE_BYTES = settings.max_file_size_bytes
+MAX_FILE_SIZE_MB = settings.max_file_size_mb
+
 # Track media groups to avoid duplicate messages
-media_group_tracker = {}  # {media_group_id: (timestamp, job_count)}
+MEDIA_GROUP_TTL = 5
+MEDIA_GROUP_TRACKER_SIZE = 10_000
+ALBUM_SETTLE_TIMEOUT = 0.2
+media_group_tracker = TTLCache(maxsize=MEDIA_GROUP_TRACKER_SIZE, ttl=MEDIA_GROUP_TTL)  # {media_group_id: AlbumTracker}
+
+
+class AlbumTracker:
+    """Images of a media group plus an event set whenever another image arrives"""
+
+    __slots__ = ("items", "arrived")
 
+    def __init__(self) -> None:
+        self.items: list[tuple[str, str]] = []  # (file_id, filename)
+        self.arrived = asyncio.Event()
 
-async def download_telegram_file(file: File, bot: Bot) -> bytes:
-    """Download file from Telegram servers"""
-    maybe_buffer = await bot.download(file.file_id)
+    def add(self, file_id: str, filename: str) -> None:
+        """Register another image of the group"""
+        self.items.append((file_id, filename))
+        self.arrived.set()
+
+    async def settle(self) -> None:
+        """Wait until no new image arrived for ALBUM_SETTLE_TIMEOUT"""
+        self.arrived.clear()
+        while True:
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout=ALBUM_SETTLE_TIMEOUT)
+            except TimeoutError:
+                return
+            self.arrived.clear()
+
+
+# Bound concurrent Telegram download + S3 upload work, globally and per user
+_upload_slots = asyncio.Semaphore(settings.max_concurrent_uploads)
+_user_upload_slots: dict[int, asyncio.Semaphore] = {}
+_user_upload_refs: Counter[int] = Counter()
+
+uploads_waiting = prometheus_client.Gauge(
+    name=f"{METRICS_PREFIX}_uploads_waiting",
+    documentation="Uploads waiting for a free download/upload slot.",
+)
+uploads_in_progress = prometheus_client.Gauge(
+    name=f"{METRICS_PREFIX}_uploads_in_progress",
+    documentation="Uploads holding a download/upload slot, each with one image buffer in memory.",
+)
+
+
+@asynccontextmanager
+async def upload_slot(user_id: int):
+    """Hold a per-user and a global upload slot"""
+    user_slots = _user_upload_slots.get(user_id)
+    if user_slots is None:
+        user_slots = _user_upload_slots[user_id] = asyncio.Semaphore(settings.max_concurrent_uploads_per_user)
+    _user_upload_refs[user_id] += 1
+
+    try:
+        with uploads_waiting.track_inprogress():
+            await user_slots.acquire()
+            try:
+                await _upload_slots.acquire()
+            except BaseException:
+                user_slots.release()
+                raise
+
+        try:
+            with uploads_in_progress.track_inprogress():
+                yield
+        finally:
+            _upload_slots.release()
+            user_slots.release()
+    finally:
+        # Forget the user's semaphore once nobody holds or waits on it
+        _user_upload_refs[user_id] -= 1
+        if not _user_upload_refs[user_id]:
+            del _user_upload_refs[user_id]
+            del _user_upload_slots[user_id]
+
+
+async def download_telegram_file(file_id: str, bot: Bot, destination: Optional[BytesIO] = None) -> BytesIO:
+    """Download file from Telegram servers into an in-memory buffer"""
+    # bot.download() resolves the file path with a single getFile
+    maybe_buffer = await bot.download(file_id, destination=destination or BytesIO())
     if maybe_buffer is None:
         raise RuntimeError("Download failed, got None instead of BytesIO.")
     assert isinstance(maybe_buffer, BytesIO)
-    return maybe_buffer.getvalue()
+    return maybe_buffer
 
 
-def create_processing_keyboard(job_id: uuid.UUID) -> InlineKeyboardMarkup:
-    """Create inline keyboard for processing options"""
-    return InlineKeyboardMarkup(
+async def stream_telegram_file(file_id: str, bot: Bot) -> AsyncIterator[bytes]:
+    """Yield a Telegram file's content chunk by chunk as it downloads"""
+    file = await bot.get_file(file_id)
+    async for chunk in bot.session.stream_content(url=bot.session.api.file_url(bot.token, file.file_path)):
+        yield chunk
+
+
+def create_processing_keyboard(job_key: str, remove_bg: bool = False, as_sticker: bool = False) -> InlineKeyboardMarkup:
+    """Create inline keyboard for processing options, the buttons carry the selected options"""
+    bg_text, sticker_text = TOGGLE_TEXTS[remove_bg, as_sticker]
+    state = {"job_key": job_key, "remove_bg": remove_bg, "as_sticker": as_sticker}
+
+    # Texts and callback data are trusted, so skip pydantic validation
+    return InlineKeyboardMarkup.model_construct(
         inline_keyboard=[
             [
-                InlineKeyboardButton(
-                    text="🖼️ Remove BG",
-                    callback_data=f"toggle:bg:{job_id}"
+                InlineKeyboardButton.model_construct(
+                    text=bg_text,
+                    callback_data=ToggleCallback(option="bg", **state).pack()
                 ),
-                InlineKeyboardButton(
-                    text="🎨 As Sticker",
-                    callback_data=f"toggle:sticker:{job_id}"
+                InlineKeyboardButton.model_construct(
+                    text=sticker_text,
+                    callback_data=ToggleCallback(option="sticker", **state).pack()
                 ),
             ],
             [
-                InlineKeyboardButton(
+                InlineKeyboardButton.model_construct(
                     text="▶️ Process",
-                    callback_data=f"process:start:{job_id}"
+                    callback_data=ProcessCallback(action="start", **state).pack()
                 ),
             ],
         ]
     )
 
 
-async def upload_to_s3(image_data: bytes, key: str, content_type: str = "image/jpeg") -> str:
+async def upload_to_s3(image_data: bytes | BytesIO, key: str, content_type: str = "image/jpeg") -> str:
     """Upload image to S3 with error handling"""
     try:
         logger.info(f"Uploading to S3: {key}")
@@ -68,39 +172,95 @@ async def upload_to_s3(image_data: bytes, key: str, content_type: str = "image/j
         raise
 
 
-async def create_processing_job(
-        session: AsyncSession,
+def original_file_key(user: User, job_id: uuid.UUID) -> str:
+    """S3 key of a job's original image, named after the job"""
+    return f"original/{user.telegram_id}/{job_id.hex}.jpg"
+
+
+def new_processing_job(
         user: User,
         original_filename: str,
         original_key: str,
+        short_id: str,
+        job_id: uuid.UUID,
 ) -> ImageProcessingJob:
-    """Create a new image processing job"""
-    job = ImageProcessingJob(
-        id=uuid.uuid4(),
+    """Build a new pending image processing job"""
+    return ImageProcessingJob(
+        id=job_id,
+        short_id=short_id,
         user_id=user.id,
         original_filename=original_filename,
         original_file_key=original_key,
         status=ProcessingStatus.PENDING,
-        processing_options='{"remove_bg": false, "as_sticker": false}',
-        created_at=datetime.now(timezone.utc),
-        updated_at=datetime.now(timezone.utc),
     )
+
+
+async def create_processing_job(
+        session: AsyncSession,
+        user: User,
+        original_filename: str,
+        original_key: str,
+        short_id: str,
+        job_id: uuid.UUID,
+) -> ImageProcessingJob:
+    """Insert a new image processing job, the caller commits it"""
+    job = new_processing_job(user, original_filename, original_key, short_id, job_id)
     session.add(job)
-    await session.commit()
+    await session.flush()
     logger.info(f"Created job {job.id} for file {original_key}")
     return job
 
 
-async def check_file_size(message: Message, file_size: int) -> bool:
-    """Check if file size is within limits"""
-    if file_size > settings.max_file_size_bytes:
-        await message.answer(
-            _("❌ File too large! Max size: {size} MB").format(
-                size=settings.max_file_size_mb
-            )
-        )
-        return False
-    return True
+async def store_original(bot: Bot, user: User, file_id: str, original_key: str) -> None:
+    """Stream an image from Telegram into S3"""
+    # Nothing else needs the bytes, so upload parts while the download is still running
+    async with upload_slot(user.id):
+        await s3_client.upload_stream(stream_telegram_file(file_id, bot), original_key, "image/jpeg")
+
+
+async def create_album_jobs(
+        bot: Bot,
+        user: User,
+        session: AsyncSession,
+        items: list[tuple[str, str]],
+) -> list[ImageProcessingJob]:
+    """Store all images of an album concurrently and create their jobs in one commit"""
+    job_ids = [uuid.uuid4() for _ in items]
+    keys = [original_file_key(user, job_id) for job_id in job_ids]
+    results = await asyncio.gather(
+        *(store_original(bot, user, file_id, key) for (file_id, _), key in zip(items, keys)),
+        return_exceptions=True,
+    )
+
+    jobs = []
+    for (file_id, filename), job_id, key, error in zip(items, job_ids, keys, results):
+        if isinstance(error, BaseException):
+            logger.error(f"Album image {file_id} failed for user {user.id}: {error}")
+            continue
+        jobs.append(new_processing_job(user, filename, key, generate_short_id(), job_id))
+
+    if jobs:
+        session.add_all(jobs)
+        await session.commit()
+        logger.info(f"Created {len(jobs)} album jobs for user {user.id}")
+    return jobs
+
+
+async def delete_status_message(sending: "asyncio.Task[Message]") -> None:
+    """Delete a status message once it has been sent"""
+    try:
+        await (await sending).delete()
+    except TelegramBadRequest:
+        pass
+
+
+async def send_preview(message: Message, image: bytes, job_key: str) -> Message:
+    """Send the image back with the processing options keyboard"""
+    return await message.answer_photo(
+        photo=BufferedInputFile(image, filename="preview.jpg"),
+        caption=_("🎨 Choose processing options (toggle buttons, then press Process):"),
+        reply_markup=create_processing_keyboard(job_key),
+    )
 
 
 async def handle_image_upload(
@@ -114,96 +274,110 @@ async def handle_image_upload(
         media_group_id: str = None,
 ) -> Optional[ImageProcessingJob]:
     """Common logic for handling image uploads"""
-    from aiogram.utils.i18n import gettext as _
-
-    # Check file size
-    if not await check_file_size(message, file_size):
+    # Check file size before anything is sent or downloaded
+    if file_size > MAX_FILE_SIZE_BYTES:
+        await message.answer(_("❌ File too large! Max size: {size} MB").format(size=MAX_FILE_SIZE_MB))
         return None
 
-    # Track media groups and determine if this is the first image
-    is_first_in_group = False
+    # Album images only register with their group, the first one handles the whole album
     if media_group_id:
-        current_time = time.time()
-
-        # Initialize or update tracker
-        if media_group_id not in media_group_tracker:
-            media_group_tracker[media_group_id] = {
-                'count': 0,
-                'timestamp': current_time
-            }
-            is_first_in_group = True
-
-        tracker = media_group_tracker[media_group_id]
-        tracker['count'] += 1
-        tracker['timestamp'] = current_time
-
-        # Clean up old entries (older than 5 seconds)
-        to_remove = [k for k, v in media_group_tracker.items()
-                     if current_time - v['timestamp'] > 5]
-        for k in to_remove:
-            del media_group_tracker[k]
-
-    # Only show download status for single images or first album image
-    download_msg = None
-    if not media_group_id or is_first_in_group:
-        status_text = _("📥 Downloading album...") if media_group_id else _("📥 Downloading image...")
-        download_msg = await message.answer(status_text)
+        album = media_group_tracker.get(media_group_id)
+        if album is not None:
+            album.add(file_id, filename)
+            # Re-setting the entry extends its TTL, stale groups expire on their own
+            media_group_tracker[media_group_id] = album
+            return None
+
+        album = AlbumTracker()
+        album.add(file_id, filename)
+        media_group_tracker[media_group_id] = album
+        return await handle_album_upload(message, bot, user, session, media_group_id, album)
+
+    # Status message goes out while the download starts
+    download_msg = asyncio.create_task(message.answer(_("📥 Downloading image...")))
 
+    # Read before the try, a rollback expires the user and reloading it would need a greenlet
+    user_id = user.id
+    preview_task = None
     try:
-        # Download image
-        file_info = await bot.get_file(file_id)
-        image_data = await download_telegram_file(file_info, bot)
-        logger.info(f"Downloaded image: {len(image_data)} bytes")
-
-        # Generate S3 key
-        original_key = f"original/{user.telegram_id}/{uuid.uuid4()}.jpg"
-
-        # Upload to S3
-        await upload_to_s3(image_data, original_key)
-
-        # Create processing job
-        job = await create_processing_job(session, user, filename, original_key)
-
-        # Handle messaging based on album/single image
-        if media_group_id:
-            # Only send album message for the first image
-            if is_first_in_group:
-                # Wait briefly to collect most images
-                await asyncio.sleep(0.5)
-                count = media_group_tracker[media_group_id]['count']
-
-                if download_msg:
-                    await download_msg.delete()
-
-                await message.answer(
-                    _("📸 Album detected! Processing {count} images...\n"
-                      "Use /history to process them all at once.").format(count=count))
-            return None
-        else:
-            # Single image - show interactive preview
-            keyboard = create_processing_keyboard(job.id)
-            await message.answer_photo(
-                photo=BufferedInputFile(image_data, filename="preview.jpg"),
-                caption=_("🎨 Choose processing options (toggle buttons, then press Process):"),
-                reply_markup=keyboard,
-            )
-            return job
+        async with upload_slot(user.id):
+            # Download image
+            image_data = await download_telegram_file(file_id, bot)
+            logger.info(f"Downloaded image: {image_data.getbuffer().nbytes} bytes")
+
+            # The S3 key is named after the job, so both come from one id
+            job_id = uuid.uuid4()
+            original_key = original_file_key(user, job_id)
+
+            # The short id is known upfront, so the preview goes out together with
+            # the S3 upload and the job insert; commit once the original is stored
+            short_id = generate_short_id()
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(upload_to_s3(image_data, original_key))
+                job_task = tg.create_task(create_processing_job(session, user, filename, original_key, short_id, job_id))
+                # getvalue() hands out the buffer's bytes without copying once nothing else views it
+                preview_task = tg.create_task(send_preview(message, image_data.getvalue(), short_id))
+            job = job_task.result()
+            await session.commit()
+
+        return job
 
     except Exception as e:
-        # Clean up on error
-        if download_msg:
-            await download_msg.delete()
-            logger.error(f"Image processing failed for user {user.id}: {e}", exc_info=True)
-            return await message.answer(_("❌ Processing failed. Please try again."))
-
-    finally:
-        # Always clean up download message for single images
-        if download_msg and not media_group_id:
+        # Drop the flushed job so the session middleware doesn't commit it without
+        # its original, and take back the preview that already points at it
+        await session.rollback()
+        if preview_task is not None and preview_task.done() and not preview_task.cancelled() \
+                and preview_task.exception() is None:
             try:
-                await download_msg.delete()
-            except Exception:
+                await preview_task.result().delete()
+            except TelegramBadRequest:
                 pass
 
+        logger.error(f"Image processing failed for user {user_id}: {e}", exc_info=True)
+        await message.answer(_("❌ Processing failed. Please try again."))
+        return None
+
+    finally:
+        # Always clean up download message
+        await delete_status_message(download_msg)
+
+
+async def handle_album_upload(
+        message: Message,
+        bot: Bot,
+        user: User,
+        session: AsyncSession,
+        media_group_id: str,
+        album: AlbumTracker,
+) -> None:
+    """Collect the rest of an album, then store it and create all its jobs at once"""
+    # Status message goes out while the album settles
+    download_msg = asyncio.create_task(message.answer(_("📥 Downloading album...")))
+
+    # Read before the try, a rollback expires the user and reloading it would need a greenlet
+    user_id = user.id
+    try:
+        # Wait until the rest of the album stops arriving, late images start a new batch
+        await album.settle()
+        media_group_tracker.pop(media_group_id, None)
+
+        jobs = await create_album_jobs(bot, user, session, album.items)
+        if not jobs:
+            await message.answer(_("❌ Processing failed. Please try again."))
+            return
+
+        await message.answer(
+            _("📸 Album detected! Processing {count} images...\n"
+              "Use /history to process them all at once.").format(count=len(jobs)))
+
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Album processing failed for user {user_id}: {e}", exc_info=True)
+        await message.answer(_("❌ Processing failed. Please try again."))
+
+    finally:
+        await delete_status_message(download_msg)
+
 
 @router.message(F.photo)
 async def handle_photo(
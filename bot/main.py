@@ -4,31 +4,62 @@ import uvloop
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.types import User as TelegramUser
 
 from bot.handlers import router
 from bot.handlers.metrics import MetricsView
 from bot.middlewares import init_middlewares
+from bot.middlewares.outbound_limiter import OutboundLimiter
 from bot.middlewares.prometheus import prometheus_middleware_factory
+from bot.services.last_seen import start_last_seen_flusher, stop_last_seen_flusher
+from bot.services.task_publisher import start_publisher, stop_publisher
 from shared.config import settings
 from shared.database import close_database, init_database, db
+from shared.redis_client import redis_client
+from shared.s3_client import s3_client
 from loguru import logger
 
 bot = Bot(
     token=settings.bot_token.get_secret_value(),
     default=DefaultBotProperties(parse_mode="HTML"),
 )
+bot.session.middleware(OutboundLimiter())
 
-dp = Dispatcher(storage=RedisStorage.from_url(settings.redis_url))
+# Pending connection queue for webhook bursts
+WEBHOOK_BACKLOG = 2048
+
+dp = Dispatcher(storage=RedisStorage(redis=redis_client))
+
+# getMe result shared across restarts, keyed by the bot id from the token
+BOT_INFO_KEY = f"bot:me:{bot.id}"
+BOT_INFO_TTL = 3600
+
+
+async def load_bot_info() -> TelegramUser:
+    """Bot identity from Redis, getMe only when it is not cached"""
+    cached = await redis_client.get(BOT_INFO_KEY)
+    if cached is not None:
+        bot_info = TelegramUser.model_validate_json(cached)
+    else:
+        bot_info = await bot.get_me()
+        await redis_client.set(BOT_INFO_KEY, bot_info.model_dump_json(exclude_none=True), ex=BOT_INFO_TTL)
+    return bot_info
 
 
 async def on_startup():
-    await init_database(create_tables=True)
+    await init_database(create_tables=settings.auto_migrate)
     if not await db.health_check():
         raise RuntimeError("DB not healthy")
     init_middlewares(dp)
     dp.include_router(router)
-
-    bot_info = await bot.get_me()
+    start_publisher()
+    start_last_seen_flusher()
+    # The first upload would otherwise pay for the bucket check
+    await s3_client.ensure_bucket()
+
+    # Handlers get the cached identity as the bot_info argument instead of calling Bot.me()
+    bot_info = await load_bot_info()
+    dp["bot_info"] = bot_info
     logger.info(f"Name     - {bot_info.full_name}")
     logger.info(f"Username - @{bot_info.username}")
     logger.info(f"ID       - {bot_info.id}")
@@ -47,7 +78,10 @@ async def on_startup():
 async def on_shutdown():
     """Clean shutdown"""
     logger.info("Shutting down bot...")
+    await stop_publisher()
+    await stop_last_seen_flusher()
     await close_database()
+    await redis_client.aclose()
     await bot.delete_webhook(drop_pending_updates=False)
 
     await bot.session.close()
@@ -85,13 +119,14 @@ async def main():
             secret_token=settings.bot_secret_token,
         ).register(app, path=webhook_path)
 
-        runner = web.AppRunner(app)
+        # Per-request access logs are skipped, /metrics covers request accounting
+        runner = web.AppRunner(app, access_log=None)
         await runner.setup()
 
         # Use configurable port (get from env or default to 8443)
         port = int(settings.webhook_port) if hasattr(settings, 'webhook_port') else 8443
 
-        site = web.TCPSite(runner, host="0.0.0.0", port=port)
+        site = web.TCPSite(runner, host="0.0.0.0", port=port, backlog=WEBHOOK_BACKLOG)
         await site.start()
 
         # Set webhook with HTTPS URL and secret token
@@ -6,7 +6,6 @@ from .session import DatabaseMiddleware
 from .i18n import CustomI18nMiddleware
 from .user_management import UserManagementMiddleware
 from .quota_check import QuotaCheckMiddleware
-from bot.handlers import photo, callbacks
 
 # Setup i18n
 i18n = I18n(path="bot/locales", default_locale="en", domain="messages")
@@ -14,12 +13,13 @@ i18n = I18n(path="bot/locales", default_locale="en", domain="messages")
 def init_middlewares(dp: Dispatcher):
     dp.update.middleware(CustomI18nMiddleware(i18n))
 
-    dp.update.middleware(DatabaseMiddleware(db.session))
-
     # Register global middlewares (order matters!)
+    # UserManagementMiddleware works in the session opened by DatabaseMiddleware
+    dp.update.middleware(DatabaseMiddleware(db.session))
     dp.update.middleware(UserManagementMiddleware())
 
-    # Register quota middleware only for specific routers
-    photo.router.message.middleware(QuotaCheckMiddleware())
-    photo.router.callback_query.middleware(QuotaCheckMiddleware())
-    callbacks.router.callback_query.middleware(QuotaCheckMiddleware())
\ No newline at end of file
+    # Quota check rejects uploads and process callbacks before any router filter runs;
+    # outer middlewares on the event observers run after the update middlewares above
+    quota_check = QuotaCheckMiddleware()
+    dp.message.outer_middleware(quota_check)
+    dp.callback_query.outer_middleware(quota_check)
\ No newline at end of file
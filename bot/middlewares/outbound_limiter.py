@@ -0,0 +1,84 @@
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from loguru import logger
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+# Telegram limits: ~30 requests/s bot-wide, ~1 message/s per chat on average.
+# Short bursts per chat are tolerated, so a status message and the reply after it go out together.
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+PER_CHAT_BURST = 3
+CHAT_SLOTS_PRUNE_SIZE = 10_000
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Request middleware that paces outbound Bot API calls to stay under Telegram limits"""
+
+    def __init__(
+            self,
+            global_rate: int = GLOBAL_RATE,
+            per_chat_interval: float = PER_CHAT_INTERVAL,
+            per_chat_burst: int = PER_CHAT_BURST,
+    ) -> None:
+        self._global = asyncio.Semaphore(global_rate)
+        self._per_chat_interval = per_chat_interval
+        # How far ahead of its steady pace a chat may run, i.e. the burst beyond the first send
+        self._per_chat_tolerance = (per_chat_burst - 1) * per_chat_interval
+        # chat id -> when the chat's token bucket is full again
+        self._chat_full_at: dict[int | str, float] = {}
+        self._paused_until = 0.0
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: "Bot",
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None and method.__api_method__.startswith("send"):
+            await self._wait_chat_slot(chat_id)
+
+        try:
+            return await self._request(make_request, bot, method)
+        except TelegramRetryAfter as e:
+            # Flood control hit: halt all outbound requests, then retry once
+            logger.warning(f"Telegram flood control, pausing outbound requests for {e.retry_after}s")
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            return await self._request(make_request, bot, method)
+
+    async def _request(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: "Bot",
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        # Sliding one-second window: each slot is given back a second after it was taken
+        await self._global.acquire()
+        asyncio.get_running_loop().call_later(1.0, self._global.release)
+
+        return await make_request(bot, method)
+
+    async def _wait_chat_slot(self, chat_id: int | str) -> None:
+        """Take a token from the chat's bucket, sleeping only once a burst has used them up"""
+        now = time.monotonic()
+        full_at = max(now, self._chat_full_at.get(chat_id, 0.0))
+        slot = max(now, full_at - self._per_chat_tolerance)
+        self._chat_full_at[chat_id] = full_at + self._per_chat_interval
+
+        if len(self._chat_full_at) > CHAT_SLOTS_PRUNE_SIZE:
+            self._chat_full_at = {k: v for k, v in self._chat_full_at.items() if v > now}
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
@@ -59,7 +59,7 @@ def prometheus_middleware_factory(
 
     @middleware
     async def prometheus_middleware(request: Request, handler: Handler) -> StreamResponse:
-        loop = asyncio.get_running_loop() or asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
 
         try:
             path_template = getattr(
@@ -1,9 +1,21 @@
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
-from aiogram.utils.i18n import gettext as _
+from bot.utils.callback_data import PROCESS_PREFIX
+from bot.utils.i18n import gettext as _
 
-from shared.models import User
+from shared.models import User, UserTier
+
+# Tiers that are never quota limited
+UNLIMITED_TIERS = frozenset({UserTier.ADMIN, UserTier.PREMIUM})
+
+
+def is_image_upload(message: Message) -> bool:
+    """Same match as the photo router: a photo, or a document with an image MIME type"""
+    if message.photo:
+        return True
+    document = message.document
+    return bool(document and document.mime_type and document.mime_type.startswith("image/"))
 
 
 class QuotaCheckMiddleware(BaseMiddleware):
@@ -17,34 +29,32 @@ class QuotaCheckMiddleware(BaseMiddleware):
     ) -> Any:
         user: User | None = data.get("user")
 
-        if not user or user.tier in {"admin", "premium"}:
+        if not user or user.tier in UNLIMITED_TIERS or user.quota_used < user.quota_limit:
             return await handler(event, data)
 
-        if isinstance(event, Message) and (event.photo or event.document):
-            if user.quota_used >= user.quota_limit:
-                await event.answer(
-                    _("❌ Quota exceeded!\n\n"
-                      "Your limit: {limit} images/day\n"
-                      "Used: {used}\n\n"
-                      "Use /quota to check your usage").format(
-                        limit=user.quota_limit,
-                        used=user.quota_used,
-                    )
-                )
-                return
-
-        elif isinstance(event, CallbackQuery) and event.data and "process:" in event.data:
-            if user.quota_used >= user.quota_limit:
-                await event.answer(
-                    _("❌ Quota exceeded!\n\n"
-                      "Your limit: {limit} images/day\n"
-                      "Used: {used}\n\n"
-                      "Upgrade to premium for unlimited processing!").format(
-                        limit=user.quota_limit,
-                        used=user.quota_used,
-                    ),
-                    show_alert=True,
+        if isinstance(event, Message) and is_image_upload(event):
+            await event.answer(
+                _("❌ Quota exceeded!\n\n"
+                  "Your limit: {limit} images/day\n"
+                  "Used: {used}\n\n"
+                  "Use /quota to check your usage").format(
+                    limit=user.quota_limit,
+                    used=user.quota_used,
                 )
-                return
+            )
+            return
+
+        elif isinstance(event, CallbackQuery) and event.data and event.data.startswith(PROCESS_PREFIX):
+            await event.answer(
+                _("❌ Quota exceeded!\n\n"
+                  "Your limit: {limit} images/day\n"
+                  "Used: {used}\n\n"
+                  "Upgrade to premium for unlimited processing!").format(
+                    limit=user.quota_limit,
+                    used=user.quota_used,
+                ),
+                show_alert=True,
+            )
+            return
 
         return await handler(event, data)
@@ -1,15 +1,47 @@
 from typing import Callable, Dict, Any, Awaitable
-from datetime import datetime, timezone
 
 from aiogram import BaseMiddleware
 from aiogram.types import Update, User as TelegramUser
+from cachetools import TTLCache
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from shared.database import db
+from bot.services.last_seen import touch_last_seen
+from bot.services.user_cache import cached_user, forget_user, remember_user
 from shared.models import User, UserTier
 from shared.config import settings
 from loguru import logger
 
+# Telegram ids whose last_seen was written within the last LAST_SEEN_INTERVAL seconds
+LAST_SEEN_INTERVAL = 300
+_recently_seen = TTLCache(maxsize=100_000, ttl=LAST_SEEN_INTERVAL)
+
+
+async def register_user(session: AsyncSession, telegram_user: TelegramUser) -> User:
+    """Insert a new user and load it in one round trip, a concurrent registration wins the race"""
+    result = await session.execute(
+        insert(User)
+        .values(
+            telegram_id=telegram_user.id,
+            username=telegram_user.username,
+            first_name=telegram_user.first_name or telegram_user.username or "User",
+            tier=UserTier.ADMIN if telegram_user.id == settings.ADMIN_ID else UserTier.FREE,
+            quota_limit=settings.default_quota_free,
+            quota_used=0,
+        )
+        .on_conflict_do_nothing(index_elements=[User.telegram_id])
+        .returning(User)
+    )
+    user = result.scalar_one_or_none()
+    if user is None:
+        result = await session.execute(select(User).where(User.telegram_id == telegram_user.id))
+        user = result.scalar_one()
+
+    await session.commit()
+    remember_user(user)
+    return user
+
 
 class UserManagementMiddleware(BaseMiddleware):
     """Middleware for automatic user registration and metadata tracking"""
@@ -35,40 +67,44 @@ class UserManagementMiddleware(BaseMiddleware):
         if not telegram_user:
             return await handler(event, data)
 
-        # Get or create user in database
-        async with db.session() as session:
+        # Get or create user in the handler's session, so the handler's commit covers it
+        session: AsyncSession = data["session"]
+        user = cached_user(telegram_user.id)
+        if user is not None:
+            session.add(user)
+        else:
             result = await session.execute(select(User).where(User.telegram_id == telegram_user.id))
             user = result.scalar_one_or_none()
+            if user:
+                remember_user(user)
 
-            if not user:
-                user = User(
-                    telegram_id=telegram_user.id,
-                    username=telegram_user.username,
-                    full_name=telegram_user.first_name or telegram_user.username or "User",
-                    tier=UserTier.ADMIN if telegram_user.id == settings.ADMIN_ID else UserTier.FREE,
-                    quota_limit=settings.default_quota_free,
-                    quota_used=0,
-                    created_at=datetime.now(timezone.utc),
-                    last_seen=datetime.now(timezone.utc),
-                    is_active=True,
-                )
-                session.add(user)
-                try:
-                    await session.commit()
-                    await session.refresh(user)
-                    logger.info(f"✅ New user registered: {user.telegram_id} (@{user.username})")
-                except Exception as e:
-                    await session.rollback()
-                    logger.error(f"Failed to create user: {e}")
-            else:
-                user.last_seen = datetime.now(timezone.utc)
+        if not user:
+            try:
+                user = await register_user(session, telegram_user)
+                logger.info(f"✅ New user registered: {user.telegram_id} (@{user.username})")
+            except Exception as e:
+                await session.rollback()
+                logger.error(f"Failed to create user: {e}")
+        else:
+            # last_seen only needs minute precision, hand it to the batched flush at most once per interval
+            if telegram_user.id not in _recently_seen:
+                touch_last_seen(user.id)
+                _recently_seen[telegram_user.id] = True
+            if not user.is_active:
                 user.is_active = True
-                if user.username != telegram_user.username:
-                    user.username = telegram_user.username
-                if user.first_name != (telegram_user.first_name or telegram_user.username or "User"):
-                    user.first_name = telegram_user.first_name or telegram_user.username or "User"
-                await session.commit()
+            if user.username != telegram_user.username:
+                user.username = telegram_user.username
+                forget_user(telegram_user.id)
+            if user.first_name != (telegram_user.first_name or telegram_user.username or "User"):
+                user.first_name = telegram_user.first_name or telegram_user.username or "User"
+                forget_user(telegram_user.id)
+
+        data["user"] = user
+
+        result = await handler(event, data)
 
-            data["user"] = user
+        # Persist the metadata above if the handler didn't commit it
+        if session.is_modified(user):
+            await session.commit()
 
-        return await handler(event, data)
\ No newline at end of file
+        return result
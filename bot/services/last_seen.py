@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime, timezone
+
+from loguru import logger
+from sqlalchemy import update
+
+from shared.database import db
+from shared.models import User
+
+LAST_SEEN_FLUSH_INTERVAL = 0.5
+
+# user id -> when the user was last seen, waiting for the next flush
+_pending: dict[int, datetime] = {}
+_flusher: asyncio.Task | None = None
+
+
+def touch_last_seen(user_id: int) -> None:
+    """Record activity, written to the database by the next flush"""
+    _pending[user_id] = datetime.now(timezone.utc)
+
+
+async def flush_last_seen() -> int:
+    """Write all pending last_seen values in one executemany, returns the number of users"""
+    global _pending
+
+    if not _pending:
+        return 0
+
+    batch, _pending = _pending, {}
+    async with db.session() as session:
+        await session.execute(
+            update(User),
+            [{"id": user_id, "last_seen": seen_at} for user_id, seen_at in batch.items()],
+        )
+    return len(batch)
+
+
+async def _run_flusher() -> None:
+    """Flush pending last_seen values every LAST_SEEN_FLUSH_INTERVAL"""
+    while True:
+        await asyncio.sleep(LAST_SEEN_FLUSH_INTERVAL)
+        try:
+            await flush_last_seen()
+        except Exception as e:
+            logger.error(f"last_seen flush failed: {e}")
+
+
+def start_last_seen_flusher() -> None:
+    """Start the background last_seen flusher"""
+    global _flusher
+
+    if _flusher is None:
+        _flusher = asyncio.create_task(_run_flusher())
+
+
+async def stop_last_seen_flusher() -> None:
+    """Stop the flusher and write what is still pending"""
+    global _flusher
+
+    if _flusher is None:
+        return
+
+    _flusher.cancel()
+    try:
+        await _flusher
+    except asyncio.CancelledError:
+        pass
+    _flusher = None
+
+    await flush_last_seen()
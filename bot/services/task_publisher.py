@@ -1,5 +1,12 @@
+import asyncio
+
 from celery import Celery
+from loguru import logger
+from sqlalchemy import delete, select
+
 from shared.config import settings
+from shared.database import db
+from shared.models import TaskOutbox
 
 # Initialize Celery app
 celery_app = Celery("bot_publisher")
@@ -12,14 +19,135 @@ celery_app.conf.update(
     timezone="UTC",
 )
 
+PROCESS_TASK_NAME = "processor.tasks.image_processing.process_image"
+# Background removal runs the model on GPU workers, sticker-only jobs are Pillow work for CPU workers
+GPU_QUEUE, GPU_ROUTING_KEY = "image_gpu", "image.rembg"
+CPU_QUEUE, CPU_ROUTING_KEY = "image_cpu", "image.transform"
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_POLL_INTERVAL = 1.0
+
+# Cap on concurrent broker publishes
+PUBLISH_CONCURRENCY = 32
+_publish_slots = asyncio.Semaphore(PUBLISH_CONCURRENCY)
+
+# Background outbox relay, started from bot startup
+_outbox_event: asyncio.Event | None = None
+_outbox_relay: asyncio.Task | None = None
+
+
+def _route_processing_task(options: dict) -> tuple[str, str]:
+    """Pick the queue and routing key of a job from its processing options"""
+    if options.get("remove_bg"):
+        return GPU_QUEUE, GPU_ROUTING_KEY
+    return CPU_QUEUE, CPU_ROUTING_KEY
+
 
-async def publish_processing_task(job_id: str, options: dict) -> None:
+def _send_processing_tasks(tasks: list[tuple[str, dict]]) -> int:
+    """Send tasks over one pooled broker connection, returns how many went out before a failure"""
+    sent = 0
+    try:
+        with celery_app.producer_or_acquire() as producer:
+            for job_id, options in tasks:
+                queue, routing_key = _route_processing_task(options)
+                celery_app.send_task(
+                    PROCESS_TASK_NAME,
+                    args=[job_id, options],
+                    queue=queue,
+                    routing_key=routing_key,
+                    producer=producer,
+                )
+                sent += 1
+    except Exception as e:
+        logger.error(f"Failed to publish task {sent + 1} of {len(tasks)}: {e}")
+    return sent
+
+
+async def publish_processing_tasks(tasks: list[tuple[str, dict]]) -> int:
     """
-    Publish image processing task to Celery queue
+    Publish many image processing tasks in one worker thread, returns how many were sent
     """
-    celery_app.send_task(
-        "processor.tasks.image_processing.process_image",
-        args=[job_id, options],
-        queue="image_processing",
-        routing_key="image.process",
-    )
\ No newline at end of file
+    async with _publish_slots:
+        return await asyncio.to_thread(_send_processing_tasks, tasks)
+
+
+def outbox_entry(job_id: str, options: dict) -> TaskOutbox:
+    """Build an outbox row to be added in the same transaction as the job update"""
+    return TaskOutbox(payload={"job_id": job_id, "options": options})
+
+
+def notify_outbox() -> None:
+    """Wake the relay right away instead of waiting for the next poll"""
+    if _outbox_event is not None:
+        _outbox_event.set()
+
+
+async def relay_outbox_once() -> int:
+    """Publish one batch of unsent outbox rows, returns the number of rows sent"""
+    async with db.session() as session:
+        result = await session.execute(
+            select(TaskOutbox)
+            .order_by(TaskOutbox.id)
+            .limit(OUTBOX_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        entries = result.scalars().all()
+
+        if not entries:
+            return 0
+
+        # Publishing stops at the first failure, the rest is left for the next round
+        sent = await publish_processing_tasks(
+            [(entry.payload["job_id"], entry.payload["options"]) for entry in entries]
+        )
+        sent_ids = [entry.id for entry in entries[:sent]]
+
+        # Published rows are dropped in the same transaction so the table doesn't grow
+        if sent_ids:
+            await session.execute(delete(TaskOutbox).where(TaskOutbox.id.in_(sent_ids)))
+
+        return len(sent_ids)
+
+
+async def _run_outbox_relay(event: asyncio.Event) -> None:
+    """Drain the outbox whenever notified, polling as a fallback"""
+    while True:
+        event.clear()
+        try:
+            while await relay_outbox_once() == OUTBOX_BATCH_SIZE:
+                pass
+        except Exception as e:
+            logger.error(f"Outbox relay failed: {e}")
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_publisher() -> None:
+    """Start the background outbox relay"""
+    global _outbox_event, _outbox_relay
+
+    if _outbox_relay is not None:
+        return
+
+    _outbox_event = asyncio.Event()
+    _outbox_relay = asyncio.create_task(_run_outbox_relay(_outbox_event))
+
+
+async def stop_publisher() -> None:
+    """Stop the background outbox relay, unsent rows stay in the outbox"""
+    global _outbox_event, _outbox_relay
+
+    if _outbox_relay is None:
+        return
+
+    _outbox_relay.cancel()
+    try:
+        await _outbox_relay
+    except asyncio.CancelledError:
+        pass
+
+    _outbox_event = None
+    _outbox_relay = None
@@ -0,0 +1,34 @@
+from cachetools import TTLCache
+from sqlalchemy.orm import make_transient_to_detached
+
+from shared.models import User
+
+# Column snapshots of recently seen users, keyed by telegram id.
+# Bot-side quota changes call forget_user(); changes made elsewhere (admin panel)
+# show up once the snapshot expires.
+USER_CACHE_TTL = 30
+USER_CACHE_SIZE = 10_000
+_user_snapshots = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+_COLUMN_KEYS = tuple(attr.key for attr in User.__mapper__.column_attrs)
+
+
+def remember_user(user: User) -> None:
+    """Snapshot a fully loaded user's column values"""
+    _user_snapshots[user.telegram_id] = {key: getattr(user, key) for key in _COLUMN_KEYS}
+
+
+def cached_user(telegram_id: int) -> User | None:
+    """Rebuild a detached user from its snapshot, ready to session.add() without a SELECT"""
+    snapshot = _user_snapshots.get(telegram_id)
+    if snapshot is None:
+        return None
+
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return user
+
+
+def forget_user(telegram_id: int) -> None:
+    """Drop a user's snapshot after changing its row"""
+    _user_snapshots.pop(telegram_id, None)
@@ -0,0 +1,23 @@
+from aiogram.filters.callback_data import CallbackData
+
+
+class ToggleCallback(CallbackData, prefix="toggle"):
+    """Flip a processing option shown on a job's keyboard, the buttons carry the current options"""
+
+    option: str
+    job_key: str
+    remove_bg: bool
+    as_sticker: bool
+
+
+class ProcessCallback(CallbackData, prefix="process"):
+    """Start processing a job with the options shown on its keyboard"""
+
+    action: str
+    job_key: str
+    remove_bg: bool
+    as_sticker: bool
+
+
+# Packed data of every process button starts with this
+PROCESS_PREFIX = f"{ProcessCallback.__prefix__}{ProcessCallback.__separator__}"
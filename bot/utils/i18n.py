@@ -0,0 +1,15 @@
+from aiogram.utils.i18n import get_i18n
+
+# (message id, locale) -> translated template
+_templates: dict[tuple[str, str], str] = {}
+
+
+def gettext(text: str) -> str:
+    """gettext for fixed message templates, memoized per locale"""
+    i18n = get_i18n()
+    key = (text, i18n.current_locale)
+
+    template = _templates.get(key)
+    if template is None:
+        template = _templates[key] = i18n.gettext(text, locale=key[1])
+    return template
@@ -0,0 +1,77 @@
+"""job short ids, jsonb options, task outbox and history indexes
+
+Revision ID: 4e8d1b6c2a7f
+Revises: 9c1f2e7a4b3d
+Create Date: 2026-10-15 12:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '4e8d1b6c2a7f'
+down_revision: Union[str, None] = '9c1f2e7a4b3d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Options were stored as JSON text, convert them in place
+    op.alter_column(
+        'image_processing_jobs', 'processing_options',
+        existing_type=sa.Text(),
+        type_=postgresql.JSONB(astext_type=sa.Text()),
+        existing_nullable=False,
+        postgresql_using='processing_options::jsonb',
+    )
+    op.alter_column(
+        'image_processing_jobs', 'processing_options',
+        existing_type=postgresql.JSONB(astext_type=sa.Text()),
+        existing_nullable=False,
+        server_default=sa.text('\'{"remove_bg": false, "as_sticker": false}\'::jsonb'),
+    )
+
+    # Existing jobs get an 11 char URL-safe key like generate_short_id() hands out
+    op.add_column('image_processing_jobs', sa.Column('short_id', sa.String(length=16), nullable=True))
+    op.execute(
+        "UPDATE image_processing_jobs SET short_id = "
+        "translate(substr(encode(decode(md5(random()::text || id::text), 'hex'), 'base64'), 1, 11), '+/', '-_')"
+    )
+    op.alter_column('image_processing_jobs', 'short_id', existing_type=sa.String(length=16), nullable=False)
+    op.create_index(op.f('ix_image_processing_jobs_short_id'), 'image_processing_jobs', ['short_id'], unique=True)
+
+    op.create_index('ix_image_processing_jobs_user_created', 'image_processing_jobs', ['user_id', sa.text('created_at DESC'), sa.text('short_id DESC')], unique=False)
+    op.create_index('ix_image_processing_jobs_user_pending', 'image_processing_jobs', ['user_id', sa.text('created_at DESC')], unique=False, postgresql_where=sa.text("status = 'PENDING'"))
+
+    op.create_table('task_outboxes',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('task_outboxes')
+
+    op.drop_index('ix_image_processing_jobs_user_pending', table_name='image_processing_jobs', postgresql_where=sa.text("status = 'PENDING'"))
+    op.drop_index('ix_image_processing_jobs_user_created', table_name='image_processing_jobs')
+    op.drop_index(op.f('ix_image_processing_jobs_short_id'), table_name='image_processing_jobs')
+    op.drop_column('image_processing_jobs', 'short_id')
+
+    op.alter_column(
+        'image_processing_jobs', 'processing_options',
+        existing_type=postgresql.JSONB(astext_type=sa.Text()),
+        existing_nullable=False,
+        server_default=None,
+    )
+    op.alter_column(
+        'image_processing_jobs', 'processing_options',
+        existing_type=postgresql.JSONB(astext_type=sa.Text()),
+        type_=sa.Text(),
+        existing_nullable=False,
+        postgresql_using='processing_options::text',
+    )
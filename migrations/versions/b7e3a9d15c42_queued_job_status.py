@@ -0,0 +1,25 @@
+"""queued job status
+
+Revision ID: b7e3a9d15c42
+Revises: 4e8d1b6c2a7f
+Create Date: 2026-10-15 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e3a9d15c42'
+down_revision: Union[str, None] = '4e8d1b6c2a7f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TYPE processingstatus ADD VALUE IF NOT EXISTS 'QUEUED' AFTER 'PENDING'")
+
+
+def downgrade() -> None:
+    # Enum values can't be dropped, queued jobs go back to pending instead
+    op.execute("UPDATE image_processing_jobs SET status = 'PENDING' WHERE status = 'QUEUED'")
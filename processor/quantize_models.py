@@ -0,0 +1,69 @@
+"""Write reduced precision copies of the background removal models
+
+Usage: python -m processor.quantize_models {int8,fp16} OUTPUT_DIR
+
+int8 suits CPU workers (dynamic quantization, VNNI capable CPUs gain the most),
+fp16 suits CUDA workers. Needs the `onnx` package next to onnxruntime. Point the
+workers at the written files with the printed WITHOUTBG_*_MODEL_PATH variables,
+unset them to go back to the stock FP32 models. Compare results on a few real
+uploads before switching, the matting stage is the most sensitive to precision.
+"""
+import argparse
+from pathlib import Path
+
+from withoutbg.models import OpenSourceModel
+
+# Stage name -> path resolver of the stock model, downloaded from Hugging Face if missing
+MODEL_STAGES = {
+    "depth": OpenSourceModel._get_default_depth_model_path,
+    "isnet": OpenSourceModel._get_default_isnet_model_path,
+    "matting": OpenSourceModel._get_default_matting_model_path,
+    "refiner": OpenSourceModel._get_default_refiner_model_path,
+}
+
+
+def quantize_int8(source: Path, target: Path) -> None:
+    """Dynamic INT8 quantization of the weights, activations are quantized at run time"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(str(source), str(target), weight_type=QuantType.QInt8)
+
+
+def convert_fp16(source: Path, target: Path) -> None:
+    """FP16 weights and activations, inputs and outputs stay FP32 for the existing pre/post-processing"""
+    import onnx
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+
+    model = convert_float_to_float16(onnx.load(str(source)), keep_io_types=True)
+    onnx.save(model, str(target))
+
+
+CONVERTERS = {
+    "int8": quantize_int8,
+    "fp16": convert_fp16,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Write reduced precision copies of the withoutbg models")
+    parser.add_argument("precision", choices=CONVERTERS)
+    parser.add_argument("output_dir", type=Path)
+    args = parser.parse_args()
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    convert = CONVERTERS[args.precision]
+
+    env_lines = []
+    for stage, resolve_path in MODEL_STAGES.items():
+        # The resolvers only read env vars and the HF cache, no loaded model is needed
+        source = Path(resolve_path(OpenSourceModel.__new__(OpenSourceModel)))
+        target = args.output_dir / f"{source.stem}_{args.precision}.onnx"
+        convert(source, target)
+        print(f"{stage}: {source.stat().st_size >> 20} MB -> {target.stat().st_size >> 20} MB")
+        env_lines.append(f"WITHOUTBG_{stage.upper()}_MODEL_PATH={target.resolve()}")
+
+    print("\n".join(["", *env_lines]))
+
+
+if __name__ == "__main__":
+    main()
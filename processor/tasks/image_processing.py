@@ -1,9 +1,17 @@
+import hashlib
 import io
+import os
 import time
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 
+import onnxruntime as ort
+import redis
 import requests
 from celery import shared_task
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, worker_shutdown
+from loguru import logger
+from sqlalchemy import func, select
 
 from PIL import Image
 from withoutbg import WithoutBG
@@ -13,8 +21,132 @@ from shared.database import db
 from shared.models import ImageProcessingJob, ProcessingStatus, User
 from shared.s3_client import s3_client
 
-# Initialize the bg remover model
-model = WithoutBG.opensource()
+# Background removal model, loaded once per worker process and reused by every task
+_model: WithoutBG | None = None
+
+# Keep-alive connections to the Bot API, reused by every task of the worker process,
+# sized for a threaded delivery worker running one delivery per thread
+telegram_http = requests.Session()
+telegram_http.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=settings.worker_concurrency))
+# Telegram file ids of delivered results keyed by their content addressed S3 key, re-sends skip the upload
+RESULT_FILE_ID_TTL = 24 * 60 * 60
+result_file_ids = redis.Redis.from_url(settings.redis_url)
+# Bump when processing changes its output, older cached results are then no longer reused
+RESULT_CACHE_VERSION = 1
+# Background I/O of a task: fetching the original during the status commit
+task_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="task-io")
+# Results are sent to Telegram by I/O-bound delivery workers, not by the processing slot
+DELIVERY_QUEUE = "image_delivery"
+DELIVERY_MAX_RETRIES = 3
+
+# Fast zlib level for result PNGs: deflate dominated encode time at the default level 6,
+# level 1 is several times faster for a slightly larger file
+PNG_COMPRESS_LEVEL = 1
+# WebP effort for stickers: method 2 encodes ~40% faster than Pillow's default 4
+# at quality 95, for a file about 1.5% larger
+WEBP_METHOD = 2
+
+# Telegram sticker bounds, and how close box reduction may get before the final LANCZOS pass
+STICKER_SIZE = (512, 512)
+STICKER_REDUCING_GAP = 3.0
+# Sticker-only JPEGs are decoded at the DCT scale covering twice the sticker size,
+# leaving LANCZOS real pixels to filter instead of libjpeg's coarse final scale
+STICKER_DRAFT_SIZE = (STICKER_SIZE[0] * 2, STICKER_SIZE[1] * 2)
+
+# ONNX Runtime execution providers in order of preference, CPU is always available
+INFERENCE_PROVIDERS = ("TensorrtExecutionProvider", "CUDAExecutionProvider", "CPUExecutionProvider")
+MODEL_STAGES = ("depth", "isnet", "matting", "refiner")
+# TensorRT tunes an engine per model on its first run, cached on disk so restarts reuse them
+TENSORRT_OPTIONS = MappingProxyType({
+    "trt_engine_cache_enable": True,
+    "trt_engine_cache_path": settings.trt_engine_cache_path,
+    "trt_fp16_enable": settings.trt_fp16_enable,
+})
+# Queue of background removal jobs, workers not consuming it never load the model up front
+MODEL_QUEUE = "image_gpu"
+# Dummy input run through the model once per process so the first job doesn't pay for engine builds
+WARMUP_SIZE = (320, 320)
+
+
+def get_model() -> WithoutBG:
+    """Return this process's bg remover model, loading it on first use"""
+    global _model
+    if _model is None:
+        _model = WithoutBG.opensource()
+        _use_best_providers(_model)
+    return _model
+
+
+def _inference_threads() -> int:
+    """Intra-op threads of each ONNX session, the worker's pool processes split the CPU cores"""
+    return max(1, (os.cpu_count() or 1) // settings.worker_concurrency)
+
+
+def _use_best_providers(model: WithoutBG) -> None:
+    """Reload the model's ONNX sessions on the best provider with this process's share of threads"""
+    available = ort.get_available_providers()
+    providers = [
+        (provider, dict(TENSORRT_OPTIONS)) if provider == "TensorrtExecutionProvider" else provider
+        for provider in INFERENCE_PROVIDERS
+        if provider in available
+    ]
+
+    # withoutbg loads its sessions for CPU with one thread per core, which oversubscribes
+    # the CPU as soon as the worker runs more than one pool process
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = _inference_threads()
+
+    pipeline = model.model
+    for stage in MODEL_STAGES:
+        path = getattr(pipeline, f"{stage}_model_path")
+        session = ort.InferenceSession(str(path), sess_options=options, providers=providers)
+        setattr(pipeline, f"{stage}_session", session)
+
+
+def _load_model() -> None:
+    """Load the model and warm it up, on workers that consume the model queue only"""
+    if MODEL_QUEUE not in settings.worker_queues.split(","):
+        return
+    model = get_model()
+    if "TensorrtExecutionProvider" in ort.get_available_providers():
+        # Builds the TensorRT engines, or loads them from the cache, before the first job
+        model.remove_background(Image.new("RGB", WARMUP_SIZE))
+
+
+@worker_process_init.connect
+def load_model(**kwargs):
+    """Load the model in each forked child, ONNX Runtime sessions don't survive a fork"""
+    if settings.worker_forks:
+        _load_model()
+
+
+@worker_init.connect
+def load_model_in_process(**kwargs):
+    """Load the model up front on pools that never fork"""
+    if not settings.worker_forks:
+        _load_model()
+
+
+def _close_task_io() -> None:
+    """Finish pending deliveries and close pooled Bot API connections"""
+    task_io.shutdown(wait=True)
+    telegram_http.close()
+
+
+@worker_process_shutdown.connect
+def close_telegram_http(**kwargs):
+    """Clean up when a forked pool process exits"""
+    if settings.worker_forks:
+        _close_task_io()
+
+
+@worker_shutdown.connect
+def close_telegram_http_in_process(**kwargs):
+    """Clean up when a worker running tasks in its own process exits"""
+    if not settings.worker_forks:
+        _close_task_io()
+
 
 @shared_task(bind=True, name="processor.tasks.image_processing.process_image")
 def process_image(self, job_id: str, options: dict):
@@ -23,93 +155,136 @@ def process_image(self, job_id: str, options: dict):
 
     with db.sync_session() as session:
         try:
-            job = session.get(ImageProcessingJob, job_id)
-            if not job:
+            # The job and its owner's chat in one round trip
+            row = session.execute(
+                select(ImageProcessingJob, User.telegram_id)
+                .join(User, User.id == ImageProcessingJob.user_id)
+                .where(ImageProcessingJob.id == job_id)
+            ).first()
+            if not row:
                 raise ValueError(f"Job {job_id} not found")
+            job, telegram_id = row
 
-            _update_job_status(session, job, ProcessingStatus.PROCESSING)
-
-            # Download original from S3
-            original_data = _download_from_s3(job.original_file_key)
+            # Download and decode the original while the PROCESSING status commits,
+            # straight at sticker scale when nothing else needs full size
+            draft_size = STICKER_DRAFT_SIZE if options.get("as_sticker") and not options.get("remove_bg") else None
+            original_future = task_io.submit(_load_original, job.original_file_key, options, draft_size)
 
-            # Process image
-            processed_data = _process_image_data(original_data, options)
+            _update_job_status(session, job, ProcessingStatus.PROCESSING)
+            processed_key, original = original_future.result()
 
-            # Upload result to S3
-            processed_key = _upload_to_s3(job, processed_data, options)
+            # Nothing to do when the same image was processed with the same options before
+            if original is not None:
+                processed_data = _process_image_data(original, options)
+                _upload_to_s3(processed_key, processed_data, options)
 
             # Update job with results
             _complete_job(session, job, processed_key, start_time)
 
-            # Send result to user
-            _send_result_to_user(session, job, processed_data, options)
+            deliver_result.apply_async(
+                args=[job_id, telegram_id, processed_key, options],
+                queue=DELIVERY_QUEUE,
+            )
 
         except Exception as e:
             _handle_job_failure(session, job_id, e)
             raise
 
 
+@shared_task(bind=True, name="processor.tasks.image_processing.deliver_result", max_retries=DELIVERY_MAX_RETRIES)
+def deliver_result(self, job_id: str, telegram_id: int, processed_key: str, options: dict):
+    """Send a stored result to its user, network errors are retried before the job is failed"""
+    try:
+        _send_result_to_user(telegram_id, job_id, processed_key, options)
+    except requests.RequestException as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=2 ** self.request.retries)
+        _fail_delivery(job_id, e)
+        raise
+    except Exception as e:
+        _fail_delivery(job_id, e)
+        raise
+
+
+def _fail_delivery(job_id: str, error: Exception):
+    """Fail a completed job whose result never reached the user"""
+    with db.sync_session() as session:
+        _handle_job_failure(session, job_id, error)
+
+
 def _download_from_s3(file_key: str) -> bytes:
     """Download file from S3 synchronously"""
-    import asyncio
+    return s3_client.download_file_sync(file_key)
+
+
+def _load_original(
+        file_key: str,
+        options: dict,
+        draft_size: tuple[int, int] | None = None,
+) -> tuple[str, Image.Image | None]:
+    """Download an original, returns its result key and the decoded image unless that result is stored
+
+    With a draft size, JPEGs are decoded at the smallest DCT scale still covering it,
+    other formats ignore it and decode at full size. The encoded bytes are released
+    before processing starts.
+    """
+    data = _download_from_s3(file_key)
+    processed_key = _result_key(data, options)
+    if s3_client.exists_sync(processed_key):
+        return processed_key, None
+
+    with io.BytesIO(data) as buffer:
+        img = Image.open(buffer)
+        if draft_size is not None:
+            img.draft("RGB", draft_size)
+        img.load()
+    return processed_key, img
+
+
+def _result_key(original: bytes, options: dict) -> str:
+    """Content addressed S3 key of the result, identical jobs map to the same object"""
+    remove_bg = options.get("remove_bg", False)
+    as_sticker = options.get("as_sticker", False)
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(s3_client.download_file(file_key))
-    finally:
-        loop.close()
+    digest = hashlib.sha256(original)
+    digest.update(f":{RESULT_CACHE_VERSION}:{remove_bg:d}:{as_sticker:d}".encode())
+    return f"processed/cache/{digest.hexdigest()}{_get_file_extension(options)}"
 
 
-def _upload_to_s3(job: ImageProcessingJob, data: bytes, options: dict) -> str:
+def _upload_to_s3(processed_key: str, data: bytes, options: dict) -> None:
     """Upload file to S3 synchronously"""
-    import asyncio
-
-    extension = _get_file_extension(options)
     content_type = _get_content_type(options)
-    processed_key = f"processed/{job.user_id}/{job.id}{extension}"
-
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(
-            s3_client.upload_file(data, processed_key, content_type)
-        )
-    finally:
-        loop.close()
-
-    return processed_key
+    s3_client.upload_file_sync(data, processed_key, content_type)
 
 
-def _process_image_data(image_data: bytes, options: dict) -> bytes:
+def _process_image_data(img: Image.Image, options: dict) -> bytes:
     """Core image processing logic"""
-    img = Image.open(io.BytesIO(image_data))
 
     remove_bg = options.get("remove_bg", False)
     as_sticker = options.get("as_sticker", False)
 
     # Remove background if requested
     if remove_bg:
-        img = model.remove_background(img)
+        img = get_model().remove_background(img)
 
     # Convert to sticker format if requested
     if as_sticker:
         img = _convert_to_sticker(img)
         # Save as WebP for stickers
         output_buffer = io.BytesIO()
-        img.save(output_buffer, format="WEBP", quality=95)
+        img.save(output_buffer, format="WEBP", quality=95, method=WEBP_METHOD)
         return output_buffer.getvalue()
 
     # Save as PNG for regular images
     output_buffer = io.BytesIO()
-    img.save(output_buffer, format="PNG")
+    img.save(output_buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
     return output_buffer.getvalue()
 
 
 def _convert_to_sticker(img: Image.Image) -> Image.Image:
     """Convert image to Telegram sticker format (512x512 max, WebP)"""
     # Telegram stickers: max 512x512, one side must be exactly 512px
-    max_size = 512
+    max_size = STICKER_SIZE[0]
 
     # Calculate new dimensions maintaining aspect ratio
     width, height = img.size
@@ -120,8 +295,8 @@ def _convert_to_sticker(img: Image.Image) -> Image.Image:
         new_height = max_size
         new_width = int((width / height) * max_size)
 
-    # Resize image
-    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    # Resize image, large inputs are box-reduced first and only the last step is LANCZOS
+    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=STICKER_REDUCING_GAP)
 
     # Ensure RGBA for transparency support
     if img.mode != "RGBA":
@@ -145,7 +320,7 @@ def _get_content_type(options: dict) -> str:
 def _update_job_status(session, job: ImageProcessingJob, status: ProcessingStatus):
     """Update job status"""
     job.status = status
-    job.updated_at = datetime.now(timezone.utc)
+    job.updated_at = func.now()
     session.commit()
 
 
@@ -154,7 +329,7 @@ def _complete_job(session, job: ImageProcessingJob, processed_key: str, start_ti
     job.processed_file_key = processed_key
     job.status = ProcessingStatus.COMPLETED
     job.processing_time_seconds = int(time.time() - start_time)
-    job.updated_at = datetime.now(timezone.utc)
+    job.updated_at = func.now()
     session.commit()
 
 
@@ -165,54 +340,78 @@ def _handle_job_failure(session, job_id: str, error: Exception):
     if job:
         job.status = ProcessingStatus.FAILED
         job.error_message = str(error)[:500]
-        job.updated_at = datetime.now(timezone.utc)
+        job.updated_at = func.now()
         session.commit()
 
 
-def _send_result_to_user(session, job: ImageProcessingJob, image_data: bytes, options: dict):
-    """Send processed image back to user via Telegram Bot API"""
-    import requests
-
+def _send_result_to_user(telegram_id: int, job_id, processed_key: str, options: dict):
+    """Send processed image back to user via Telegram Bot API, runs without the DB session"""
     bot_token = settings.bot_token.get_secret_value()
-    user = session.get(User, job.user_id)
-
-    if not user:
-        raise ValueError(f"User {job.user_id} not found")
-
     as_sticker = options.get("as_sticker", False)
 
     if as_sticker:
-        _send_as_sticker(bot_token, user.telegram_id, image_data, job.id)
+        _send_as_sticker(bot_token, telegram_id, processed_key, job_id)
     else:
-        _send_as_document(bot_token, user.telegram_id, image_data, job.id)
+        _send_as_document(bot_token, telegram_id, processed_key, job_id)
+
+
+def _send_media(
+        url: str,
+        field: str,
+        processed_key: str,
+        upload: tuple[str, str],
+        data: dict,
+) -> requests.Response:
+    """Post a stored result, reusing the Telegram file id of an earlier upload of the same object"""
+    cache_key = f"tg:file_id:{field}:{processed_key}"
+
+    try:
+        file_id = result_file_ids.get(cache_key)
+    except redis.RedisError as e:
+        logger.warning(f"File id cache unavailable: {e}")
+        file_id = None
+
+    if file_id is not None:
+        response = telegram_http.post(url, data={**data, field: file_id.decode()})
+        if response.status_code == 200:
+            return response
+        # The file id is no longer accepted, upload the bytes again
+
+    filename, content_type = upload
+    files = {field: (filename, _download_from_s3(processed_key), content_type)}
+    response = telegram_http.post(url, files=files, data=data)
+    if response.status_code == 200:
+        try:
+            result_file_ids.set(cache_key, response.json()["result"][field]["file_id"], ex=RESULT_FILE_ID_TTL)
+        except redis.RedisError as e:
+            logger.warning(f"File id cache unavailable: {e}")
+    return response
 
 
-def _send_as_document(bot_token: str, telegram_id: int, image_data: bytes, job_id):
+def _send_as_document(bot_token: str, telegram_id: int, processed_key: str, job_id):
     """Send result as document"""
     url = f"https://api.telegram.org/bot{bot_token}/sendDocument"
 
-    files = {'document': (f"result_{job_id}.png", image_data, "image/png")}
     data = {
         'chat_id': str(telegram_id),
         'caption': f"✅ Processing complete!\nJob ID: {job_id}"
     }
 
-    response = requests.post(url, files=files, data=data)
+    response = _send_media(url, 'document', processed_key, (f"result_{job_id}.png", "image/png"), data)
     if response.status_code != 200:
         raise ValueError(f"Failed to send document: {response.text}")
 
 
-def _send_as_sticker(bot_token: str, telegram_id: int, image_data: bytes, job_id):
+def _send_as_sticker(bot_token: str, telegram_id: int, processed_key: str, job_id):
     """Send result as sticker using Telegram's sendSticker API"""
     url = f"https://api.telegram.org/bot{bot_token}/sendSticker"
 
     # Telegram stickers need to be sent as 'sticker' field, not 'document'
-    files = {'sticker': (f"sticker_{job_id}.webp", image_data, "image/webp")}
     data = {
         'chat_id': str(telegram_id),
     }
 
-    response = requests.post(url, files=files, data=data)
+    response = _send_media(url, 'sticker', processed_key, (f"sticker_{job_id}.webp", "image/webp"), data)
 
     if response.status_code != 200:
         raise ValueError(f"Failed to send sticker: {response.text}")
@@ -223,4 +422,4 @@ def _send_as_sticker(bot_token: str, telegram_id: int, image_data: bytes, job_id
         'chat_id': str(telegram_id),
         'text': f"✅ Sticker ready!\nJob ID: {job_id}"
     }
-    requests.post(url_message, data=message_data)
\ No newline at end of file
+    telegram_http.post(url_message, data=message_data)
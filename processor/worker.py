@@ -1,11 +1,39 @@
 import asyncio
 import os
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
 from shared.config import settings
 from shared.database import db
 
+# A pool process runs one task at a time, the engine it inherits is reused for all of them.
+# Thread pools share the worker's engine, so it gets a connection per thread
+WORKER_DB_POOL_SIZE = 2 if settings.worker_forks else settings.worker_concurrency
+WORKER_DB_MAX_OVERFLOW = 2
 
-asyncio.run(db.init(settings.DATABASE_URL))
+asyncio.run(db.init(
+    settings.DATABASE_URL,
+    pool_size=WORKER_DB_POOL_SIZE,
+    max_overflow=WORKER_DB_MAX_OVERFLOW,
+))
+
+
+@worker_process_init.connect
+def reset_db_pool(**kwargs):
+    """Start each forked child with an empty pool instead of the parent's sockets"""
+    db.dispose_sync(close=False)
+
+
+@worker_process_shutdown.connect
+def close_db_pool(**kwargs):
+    """Close the child's pooled connections when it exits"""
+    db.dispose_sync()
+
+
+@worker_shutdown.connect
+def close_worker_db_pool(**kwargs):
+    """Close the pooled connections of a worker running tasks in its own process"""
+    if not settings.worker_forks:
+        db.dispose_sync()
 
 # Configure Celery
 celery_app = Celery("processor")
@@ -34,7 +62,10 @@ if __name__ == "__main__":
     argv = [
         "worker",
         "--loglevel=INFO",
-        "--concurrency=2",
-        "--queues=image_processing",
+        f"--pool={settings.worker_pool}",
+        f"--concurrency={settings.worker_concurrency}",
+        f"--queues={settings.worker_queues}",
+        # Hand tasks only to idle pool processes, not to one still busy with a long job
+        "-Ofair",
     ]
     celery_app.start(argv=argv)
\ No newline at end of file
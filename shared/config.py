@@ -20,9 +20,12 @@ class Settings(BaseSettings):
     database_name: str | None = None
     DATABASE_URL : str | None = None
     DB_POOL_SIZE: int = 20
-    DB_MAX_OVERFLOW: int = 50
-    DB_POOL_RECYCLE: int = 3600
+    DB_MAX_OVERFLOW: int = 40
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_TIMEOUT: int = 5
     DB_ECHO: bool = False
+    # Create missing tables on bot startup, otherwise the schema comes from `alembic upgrade head`
+    auto_migrate: bool = False
 
     # Redis
     redis_url: str
@@ -39,8 +42,18 @@ class Settings(BaseSettings):
 
     # Processing
     max_file_size_mb: int = 20
+    max_concurrent_uploads: int = 32
+    max_concurrent_uploads_per_user: int = 4
     default_quota_free: int = 10
     default_quota_premium: int = 1000
+    # TensorRT engines of the bg remover, keep on a volume so workers don't rebuild them on restart
+    trt_engine_cache_path: str = "/var/cache/trt_engines"
+    trt_fp16_enable: bool = True
+    # Celery queues a processor consumes: image_gpu (background removal), image_cpu (stickers)
+    # and image_delivery (sending results, best run on a threads pool)
+    worker_queues: str = "image_gpu,image_cpu,image_delivery"
+    worker_concurrency: int = 2
+    worker_pool: str = "prefork"
 
     # Monitoring
     prometheus_port: int = 8000
@@ -52,5 +65,10 @@ class Settings(BaseSettings):
     def max_file_size_bytes(self) -> int:
         return self.max_file_size_mb * 1024 * 1024
 
+    @property
+    def worker_forks(self) -> bool:
+        """Whether tasks run in forked pool processes rather than in the worker process itself"""
+        return self.worker_pool == "prefork"
+
 
 settings = Settings()
\ No newline at end of file
@@ -27,6 +27,7 @@ _logger.add(
     serialize=JSON_LOGS,          # False = human, True = JSON
     backtrace=False,              # no stack in prod
     diagnose=settings.debug,      # vars in tracebacks only in debug
+    enqueue=True,                 # write from a background thread, never block the event loop
 )
 
 LOG_FILE_PATH.parent.mkdir(exist_ok=True)
@@ -37,6 +38,7 @@ _logger.add(
     serialize=True,
     level=LOG_LEVEL,
     compression="gz",
+    enqueue=True,
 )
 
 # export the configured logger
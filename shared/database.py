@@ -4,6 +4,7 @@ from contextlib import asynccontextmanager, contextmanager
 from typing import AsyncGenerator, Optional, Callable, Generator
 from functools import wraps
 
+import orjson
 from loguru import logger
 from sqlalchemy.ext.asyncio import (
     create_async_engine,
@@ -13,6 +14,7 @@ from sqlalchemy.ext.asyncio import (
 )
 from sqlalchemy.orm import DeclarativeBase, declared_attr, sessionmaker, Session as SyncSession
 from sqlalchemy import event, text, create_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -47,6 +49,11 @@ class Base(DeclarativeBase):
 
 # ==================== Database Manager ====================
 
+def _json_serializer(value) -> str:
+    """orjson-backed serializer for JSON/JSONB columns"""
+    return orjson.dumps(value).decode()
+
+
 class DatabaseError(Exception):
     """Custom database exception."""
     pass
@@ -88,8 +95,9 @@ class DatabaseManager:
             self,
             database_url: str,
             pool_size: int = 20,
-            max_overflow: int = 50,
-            pool_recycle: int = 3600,
+            max_overflow: int = 40,
+            pool_recycle: int = 1800,
+            pool_timeout: int = 5,
             echo: bool = False,
     ) -> None:
         """
@@ -104,11 +112,14 @@ class DatabaseManager:
             self._engine = create_async_engine(
                 database_url,
                 echo=echo,
+                poolclass=AsyncAdaptedQueuePool,
                 pool_pre_ping=True,
                 pool_size=pool_size,
                 max_overflow=max_overflow,
                 pool_recycle=pool_recycle,
-                pool_timeout=30,
+                pool_timeout=pool_timeout,
+                json_serializer=_json_serializer,
+                json_deserializer=orjson.loads,
                 connect_args={
                     "server_settings": {
                         "jit": "off",
@@ -136,7 +147,9 @@ class DatabaseManager:
                                                                                          'postgresql://')
             # psycopg2 is the default driver for postgresql://
             self._sync_engine = create_engine(sync_url, pool_pre_ping=True, pool_size=pool_size,
-                                              max_overflow=max_overflow, pool_recycle=pool_recycle, echo=echo)
+                                              max_overflow=max_overflow, pool_recycle=pool_recycle,
+                                              pool_timeout=pool_timeout, echo=echo,
+                                              json_serializer=_json_serializer, json_deserializer=orjson.loads)
             self._sync_session_factory = sessionmaker(bind=self._sync_engine, expire_on_commit=False, autoflush=False)
 
             self._initialized = True
@@ -202,6 +215,11 @@ class DatabaseManager:
         finally:
             session.close()
 
+    def dispose_sync(self, close: bool = True) -> None:
+        """Drop pooled sync connections, close=False leaves ones inherited over a fork to the parent"""
+        if self._sync_engine:
+            self._sync_engine.dispose(close=close)
+
     @retry(
         stop=stop_after_attempt(3),
         wait=wait_exponential(multiplier=1, min=2, max=10),
@@ -267,6 +285,7 @@ async def init_database(
         pool_size=settings.DB_POOL_SIZE,
         max_overflow=settings.DB_MAX_OVERFLOW,
         pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
         echo=settings.DB_ECHO,
     )
 
@@ -1,4 +1,5 @@
-from datetime import datetime, timezone
+import secrets
+from datetime import datetime
 from enum import Enum
 from typing import LiteralString, TYPE_CHECKING
 from uuid import UUID as PyUUID, uuid4
@@ -9,8 +10,9 @@ from sqlalchemy import (
     Integer,
     String,
     Text,
-    Enum as SQLEnum, BigInteger, Boolean,
+    Enum as SQLEnum, BigInteger, Boolean, Index, func, text,
 )
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from shared.database import Base
@@ -27,6 +29,7 @@ class UserTier(str, Enum):
 
 class ProcessingStatus(str, Enum):
     PENDING = "pending"
+    QUEUED = "queued"
     PROCESSING = "processing"
     COMPLETED = "completed"
     FAILED = "failed"
@@ -78,19 +81,19 @@ class User(Base):
     # Timestamps
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
-        default=lambda: datetime.now(timezone.utc),
+        default=func.now(),
         nullable=False,
         index=True
     )
     updated_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
-        default=lambda: datetime.now(timezone.utc),
-        onupdate=lambda: datetime.now(timezone.utc),
+        default=func.now(),
+        onupdate=func.now(),
         nullable=False
     )
     last_seen: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
-        default=lambda: datetime.now(timezone.utc),
+        default=func.now(),
         nullable=False
     )
 
@@ -141,18 +144,47 @@ class User(Base):
         return self.full_name
 
 
+def generate_short_id() -> str:
+    """Generate a compact URL-safe job key for callback data (11 chars)"""
+    return secrets.token_urlsafe(8)
+
+
 class ImageProcessingJob(Base):
     id: Mapped[PyUUID] = mapped_column(primary_key=True, default=uuid4)
+    short_id: Mapped[str] = mapped_column(String(16), unique=True, index=True, nullable=False, default=generate_short_id)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     original_filename: Mapped[str] = mapped_column(String(500), nullable=False)
     original_file_key: Mapped[str] = mapped_column(String(500), nullable=False)
     processed_file_key: Mapped[str | None] = mapped_column(String(500), nullable=True)
     status: Mapped[ProcessingStatus] = mapped_column(SQLEnum(ProcessingStatus), default=ProcessingStatus.PENDING, nullable=False)
     error_message: Mapped[str | None] = mapped_column(Text, nullable=True)
-    processing_options: Mapped[str] = mapped_column(Text, nullable=False)  # JSON string
-    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False)
-    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), nullable=False)
+    processing_options: Mapped[dict] = mapped_column(
+        JSONB,
+        nullable=False,
+        server_default=text("""'{"remove_bg": false, "as_sticker": false}'::jsonb"""),
+    )
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=func.now(), nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=func.now(), onupdate=func.now(), nullable=False)
     processing_time_seconds: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
     # Relationships
-    user: Mapped["User"] = relationship(back_populates="jobs")
\ No newline at end of file
+    user: Mapped["User"] = relationship(back_populates="jobs")
+
+    __table_args__ = (
+        # History keyset pagination: a user's jobs newest first
+        Index("ix_image_processing_jobs_user_created", "user_id", created_at.desc(), short_id.desc()),
+        # Batch processing: a user's pending jobs only
+        Index(
+            "ix_image_processing_jobs_user_pending",
+            "user_id",
+            created_at.desc(),
+            postgresql_where=status == ProcessingStatus.PENDING,
+        ),
+    )
+
+
+class TaskOutbox(Base):
+    """Processing tasks written in the job's transaction and relayed to the broker afterwards"""
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    payload: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=func.now(), nullable=False)
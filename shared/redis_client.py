@@ -0,0 +1,8 @@
+from redis.asyncio import Redis
+
+from .config import settings
+
+# One connection pool shared by every bot-side Redis user (FSM storage, ...)
+REDIS_MAX_CONNECTIONS = 50
+
+redis_client = Redis.from_url(settings.redis_url, max_connections=REDIS_MAX_CONNECTIONS)
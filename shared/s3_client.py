@@ -1,12 +1,65 @@
 import asyncio
 import io
+import os
+import queue
+import threading
 from concurrent.futures.thread import ThreadPoolExecutor
+from typing import AsyncIterable, BinaryIO, Iterable
 
+import certifi
+import urllib3
+from loguru import logger
 from minio import Minio
-from urllib.parse import urljoin
+from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
 
 from .config import settings
 
+# Streaming uploads go out as multipart uploads of this part size (the S3 minimum)
+STREAM_PART_SIZE = 5 * 1024 * 1024
+STREAM_PARALLEL_PARTS = 4
+# Uploads of known size: a single PUT up to this size, parallel parts of it above
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+# Connection and per-read timeouts of MinIO requests, in seconds
+S3_CONNECT_TIMEOUT = 5
+S3_READ_TIMEOUT = 60
+
+
+class _ChunkPipe(io.RawIOBase):
+    """Blocking reader over chunks fed from the event loop, read by the upload thread"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: queue.SimpleQueue[bytes | BaseException | None] = queue.SimpleQueue()
+        self._pending = bytearray()
+        self._eof = False
+
+    def feed(self, chunk: bytes) -> None:
+        self._chunks.put(chunk)
+
+    def close_with(self, error: BaseException | None = None) -> None:
+        """Signal end of data, or make the reader fail so the multipart upload is aborted"""
+        self._chunks.put(error)
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._pending) < size):
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+            elif isinstance(chunk, BaseException):
+                raise IOError("upload stream aborted") from chunk
+            else:
+                self._pending += chunk
+
+        if size < 0:
+            size = len(self._pending)
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
 
 class S3Client:
     def __init__(self):
@@ -15,29 +68,54 @@ class S3Client:
             access_key=settings.minio_access_key,
             secret_key=settings.minio_secret_key,
             secure=settings.minio_use_ssl,
+            http_client=self._create_http_client(),
         )
         self.bucket_name = settings.minio_bucket_name
         self.public_url = settings.minio_public_url
-        self.executor = ThreadPoolExecutor(max_workers=4)
+        # Public URLs are this prefix plus the object key
+        self._url_prefix = f"{self.public_url.rstrip('/')}/{self.bucket_name}/"
+        # One thread per upload the bot admits at once, so transfers aren't queued behind each other
+        self.executor = ThreadPoolExecutor(max_workers=settings.max_concurrent_uploads, thread_name_prefix="s3")
         self._bucket_checked = False
+        self._bucket_lock = threading.Lock()
+
+    @staticmethod
+    def _create_http_client() -> urllib3.PoolManager:
+        """Keep-alive pool with a connection per executor thread, minio's default keeps only 10"""
+        return urllib3.PoolManager(
+            maxsize=settings.max_concurrent_uploads,
+            block=False,
+            timeout=urllib3.Timeout(connect=S3_CONNECT_TIMEOUT, read=S3_READ_TIMEOUT),
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+            retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+        )
 
     def _ensure_bucket(self):
-        """Ensure bucket exists - called lazily on first use"""
+        """Ensure bucket exists - called lazily on first use, from executor threads"""
         if self._bucket_checked:
             return
 
-        try:
-            if not self.client.bucket_exists(self.bucket_name):
-                self.client.make_bucket(self.bucket_name)
-            self._bucket_checked = True
-        except Exception as e:
-            print(f"Warning: Could not check/create bucket: {e}")
-            # Don't raise - let the actual operation fail if needed
-
-    async def upload_file(self, file_data: bytes, object_key: str, content_type: str = "image/png") -> str:
+        # Concurrent first transfers wait for one check instead of racing to create the bucket
+        with self._bucket_lock:
+            if self._bucket_checked:
+                return
+            try:
+                if not self.client.bucket_exists(self.bucket_name):
+                    self.client.make_bucket(self.bucket_name)
+                self._bucket_checked = True
+            except Exception as e:
+                logger.warning(f"Could not check/create bucket: {e}")
+                # Don't raise - let the actual operation fail if needed
+
+    async def ensure_bucket(self):
+        """Check the bucket ahead of the first transfer, e.g. on startup"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._ensure_bucket)
+
+    async def upload_file(self, file_data: bytes | BinaryIO, object_key: str, content_type: str = "image/png") -> str:
         """Async wrapper for upload"""
-        self._ensure_bucket()
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         await loop.run_in_executor(
             self.executor,
             self._upload_sync,
@@ -47,48 +125,128 @@ class S3Client:
         )
         return self.get_public_url(object_key)
 
-    def _upload_sync(self, file_data: bytes, object_key: str, content_type: str):
-        """Synchronous upload logic"""
-        file_stream = io.BytesIO(file_data)
+    def upload_file_sync(self, file_data: bytes | BinaryIO, object_key: str, content_type: str = "image/png") -> str:
+        """Blocking upload, for callers without an event loop such as Celery tasks"""
+        self._upload_sync(file_data, object_key, content_type)
+        return self.get_public_url(object_key)
+
+    def _upload_sync(self, file_data: bytes | BinaryIO, object_key: str, content_type: str):
+        """Synchronous upload logic, streams are uploaded from their start"""
+        self._ensure_bucket()
+        file_stream = io.BytesIO(file_data) if isinstance(file_data, bytes) else file_data
+        length = file_stream.seek(0, io.SEEK_END)
+        file_stream.seek(0)
         self.client.put_object(
             bucket_name=self.bucket_name,
             object_name=object_key,
             data=file_stream,
-            length=len(file_data),
+            length=length,
+            part_size=UPLOAD_PART_SIZE,
+            num_parallel_uploads=STREAM_PARALLEL_PARTS,
+            content_type=content_type,
+        )
+
+    async def upload_stream(self, chunks: AsyncIterable[bytes], object_key: str, content_type: str = "image/png") -> str:
+        """Upload chunks while they are still arriving, as a multipart upload"""
+        pipe = _ChunkPipe()
+        loop = asyncio.get_running_loop()
+        upload = loop.run_in_executor(self.executor, self._upload_stream_sync, pipe, object_key, content_type)
+
+        try:
+            async for chunk in chunks:
+                pipe.feed(chunk)
+        except BaseException as e:
+            pipe.close_with(e)
+            # The thread aborts the multipart upload, its error only echoes this one
+            upload.add_done_callback(lambda f: f.exception())
+            raise
+        else:
+            pipe.close_with()
+
+        await upload
+        return self.get_public_url(object_key)
+
+    def _upload_stream_sync(self, stream: BinaryIO, object_key: str, content_type: str):
+        """Synchronous multipart upload of a stream of unknown length"""
+        self._ensure_bucket()
+        self.client.put_object(
+            bucket_name=self.bucket_name,
+            object_name=object_key,
+            data=stream,
+            length=-1,
+            part_size=STREAM_PART_SIZE,
+            num_parallel_uploads=STREAM_PARALLEL_PARTS,
             content_type=content_type,
         )
 
     async def download_file(self, object_key: str) -> bytes:
         """Async wrapper for download"""
-        self._ensure_bucket()
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         return await loop.run_in_executor(
             self.executor,
             self._download_sync,
             object_key
         )
 
+    def download_file_sync(self, object_key: str) -> bytes:
+        """Blocking download, for callers without an event loop such as Celery tasks"""
+        return self._download_sync(object_key)
+
     def _download_sync(self, object_key: str) -> bytes:
         """Synchronous download logic"""
+        self._ensure_bucket()
         response = self.client.get_object(self.bucket_name, object_key)
         data = response.read()
         response.close()
         response.release_conn()
         return data
 
+    def exists_sync(self, object_key: str) -> bool:
+        """Blocking check whether an object is stored, a single HEAD request"""
+        self._ensure_bucket()
+        try:
+            self.client.stat_object(self.bucket_name, object_key)
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchObject"):
+                return False
+            raise
+        return True
+
     def get_public_url(self, object_key: str) -> str:
-        return urljoin(f"{self.public_url}/", f"{self.bucket_name}/{object_key}")
+        return self._url_prefix + object_key
 
     async def delete_file(self, object_key: str):
         """Async wrapper for delete"""
-        self._ensure_bucket()
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         await loop.run_in_executor(
             self.executor,
-            self.client.remove_object,
-            self.bucket_name,
+            self._delete_sync,
             object_key
         )
 
+    def _delete_sync(self, object_key: str):
+        """Synchronous delete logic"""
+        self._ensure_bucket()
+        self.client.remove_object(self.bucket_name, object_key)
+
+    async def delete_files(self, object_keys: Iterable[str]) -> list[str]:
+        """Delete many objects, up to 1000 per request, returns the keys that could not be deleted"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            self._delete_many_sync,
+            list(object_keys)
+        )
+
+    def _delete_many_sync(self, object_keys: list[str]) -> list[str]:
+        """Synchronous bulk delete logic, minio batches the keys into multi-object delete requests"""
+        self._ensure_bucket()
+        errors = self.client.remove_objects(self.bucket_name, (DeleteObject(key) for key in object_keys))
+        failed = []
+        for error in errors:
+            logger.warning(f"Could not delete {error.name}: {error.code} {error.message}")
+            failed.append(error.name)
+        return failed
+
 
 s3_client = S3Client()
\ No newline at end of file